@@ -1,8 +1,5 @@
 #!/usr/bin/env python3
-import whisper
-import sounddevice as sd
 import numpy as np
-import tempfile
 import os
 import scipy.io.wavfile
 import time
@@ -10,13 +7,37 @@ import re
 import threading
 import signal
 import json
+import queue
+import collections
+import argparse
+import math
+import difflib
+import inspect
+import http.server
 from PyQt5 import QtWidgets, QtGui, QtCore
 import psutil
 import sys
 import logging
 import subprocess
-import pynput.keyboard
-from pynput.mouse import Controller as MouseController, Button as MouseButton
+import shutil
+import socket
+import socketserver
+import multiprocessing
+import concurrent.futures
+import weakref
+import copy
+import ctypes
+import ctypes.util
+import struct
+import select
+import secrets
+import hmac
+
+try:
+    import sounddevice as sd
+except (ImportError, OSError):
+    # Missing PortAudio: file replay (bench) still works
+    sd = None
 
 # Configuration path
 config_path = os.path.expanduser("~/.config/whisper-dictate/settings.json")
@@ -24,9 +45,48 @@ os.makedirs(os.path.dirname(config_path), exist_ok=True)
 default_config = {
     "startup_listening": "asleep",
     "startup_mode": "dictation",
-    "noise_suppression": {"enabled": False},
+    "noise_suppression": {"enabled": False, "highpass_hz": 80, "threshold": 2.0, "reduction_db": 18, "noise_rise_s": 3,
+                          "agc": True, "agc_target_dbfs": -20, "agc_max_gain_db": 20},
     "use_fp16": False,
     "mouse_step": 50,
+    "audio": {"block_ms": 100, "ring_seconds": 30},
+    "vad": {
+        "backend": "energy",
+        "frame_ms": 30,
+        "onset_ms": 90,
+        "hangover_ms": 600,
+        "pre_roll_ms": 300,
+        "min_utterance_ms": 250,
+        "max_utterance_s": 20,
+        "energy_ratio": 3.0,
+        "min_rms": 0.004,
+        "zcr_max": 0.45,
+        "webrtc_aggressiveness": 2
+    },
+    "asr": {"engine": "whisper", "model": "small", "device": "auto", "compute_type": "int8", "cpu_threads": 0, "beam_size": 1},
+    "streaming": {"enabled": False, "step_ms": 400, "window_s": 12, "min_audio_ms": 600},
+    "journal": {"enabled": True, "path": "~/.local/share/whisper-dictation/journal.jsonl", "max_bytes": 5000000,
+                "keep": 3, "memory": 50},
+    "metrics": {
+        "enabled": True,
+        "window": 500,
+        "jsonl_path": "~/.local/share/whisper-dictation/metrics.jsonl",
+        "jsonl_max_bytes": 5000000,
+        "summary_interval_s": 60,
+        "prometheus_port": 0
+    },
+    "injection": {"backend": "auto", "events_per_second": 400, "paste_threshold": 200, "paste_keys": "ctrl v"},
+    "commands_file": "~/.config/whisper-dictate/commands.json",
+    "command_recognizer": {"enabled": True, "model": "tiny.en", "min_confidence": 0.6, "max_audio_s": 4, "max_tokens": 24},
+    "prompting": {"enabled": True, "vocabulary": [], "history_words": 40, "max_tokens": 200, "profiles": {}},
+    "cascade": {"enabled": False, "fast_model": "tiny.en", "min_avg_logprob": -0.5, "max_no_speech_prob": 0.4,
+                "command_max_words": 6, "reuse_encoder": True},
+    "wake_word": {"enabled": True, "backend": "auto", "phrases": ["wake up", "start listening"], "max_audio_s": 2.5,
+                  "model": "tiny.en", "templates_dir": "~/.local/share/whisper-dictation/wake", "template_threshold": 0.3,
+                  "openwakeword_models": [], "openwakeword_threshold": 0.5},
+    "batch": {"backend": "auto", "workers": 0, "threads_per_worker": 0, "max_shard_s": 30},
+    "daemon": {"socket": "", "port": 47631, "token_file": "", "autostart": True},
+    "debug": {"dump_audio": False, "dump_dir": "~/.local/share/whisper-dictation/audio"},
     "app_aliases": {
         "notepad": "notepad.exe",
         "calculator": "calc.exe",
@@ -35,343 +95,3898 @@ default_config = {
         "edge": "msedge.exe"
     }
 }
-try:
-    with open(config_path, "r") as f:
-        config = json.load(f)
-except (FileNotFoundError, json.JSONDecodeError):
-    config = default_config
-    with open(config_path, "w") as f:
-        json.dump(config, f, indent=2)
+# Allowed values for string settings that select a backend or a mode. Kept
+# here rather than derived from the backend registries because the config
+# is validated before those are defined.
+config_choices = {
+    "startup_listening": ("asleep", "awake"),
+    "startup_mode": ("dictation", "command"),
+    "vad.backend": ("energy", "webrtc"),
+    "asr.engine": ("whisper", "faster-whisper"),
+    "asr.device": ("auto", "cpu", "cuda"),
+    "injection.backend": ("auto", "pynput", "xdotool", "ydotool", "recording", "null"),
+    "batch.backend": ("auto", "process", "thread"),
+    "wake_word.backend": ("auto", "templates", "whisper", "openwakeword"),
+}
+
+
+def merge_settings(base, overlay):
+    for key, value in overlay.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            merge_settings(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+
+# Schemas for the entries of lists and objects whose defaults are empty or
+# hold user-chosen keys, given as an example value like the defaults are:
+# every entry must match it (other lists take their first default entry).
+config_items = {
+    "prompting.vocabulary": "",
+    "prompting.profiles": {"apps": [""], "prompt": "", "vocabulary": [""]},
+    "wake_word.openwakeword_models": "",
+    "app_aliases": "",
+}
+
+
+def validate_settings(data, defaults, prefix=""):
+    # The schema is the defaults: every known key must hold a value of its
+    # default's type (ints and floats are interchangeable) and, for the keys
+    # in config_choices, one of the allowed values. Returns the valid part of
+    # data and a list of problems; unknown keys are kept as they are.
+    valid, errors = {}, []
+    for key, value in data.items():
+        if key not in defaults:
+            valid[key] = value
+            continue
+        ok, value, problems = validate_value(prefix + key, value, defaults[key])
+        errors += problems
+        if ok:
+            valid[key] = value
+    return valid, errors
+
+
+def validate_value(name, value, default):
+    # Returns (ok, value, problems). Objects keep their valid part; a list
+    # with a bad entry is rejected whole.
+    item = config_items.get(name)
+    if isinstance(default, dict):
+        if not isinstance(value, dict):
+            return False, value, [f"{name} should be an object, got {json.dumps(value)}"]
+        if item is not None:
+            valid, errors = {}, []
+            for key, entry in value.items():
+                ok, entry, problems = validate_value(f"{name}.{key}", entry, item)
+                errors += problems
+                if ok:
+                    valid[key] = entry
+            return True, valid, errors
+        if default:
+            valid, errors = validate_settings(value, default, name + ".")
+            return True, valid, errors
+        return True, value, []
+    if isinstance(default, list):
+        if not isinstance(value, list):
+            return False, value, [f"{name} should be a list, got {json.dumps(value)}"]
+        if item is None and default:
+            item = default[0]
+        if item is None:
+            return True, value, []
+        entries, errors = [], []
+        for i, entry in enumerate(value):
+            ok, entry, problems = validate_value(f"{name}[{i}]", entry, item)
+            errors += problems
+            if ok and not problems:
+                entries.append(entry)
+        return not errors, entries, errors
+    if isinstance(default, bool):
+        ok = isinstance(value, bool)
+    elif isinstance(default, (int, float)):
+        ok = isinstance(value, (int, float)) and not isinstance(value, bool)
+        if ok and isinstance(default, int) and isinstance(value, float) and value.is_integer():
+            value = int(value)
+    else:
+        ok = isinstance(value, type(default))
+    if not ok:
+        return False, value, [f"{name} should be {type(default).__name__}, got {json.dumps(value)}"]
+    if name in config_choices and value not in config_choices[name]:
+        return False, value, [f"{name} should be one of {', '.join(config_choices[name])}, got {json.dumps(value)}"]
+    return True, value, []
+
+
+def write_json_atomic(path, data):
+    # Readers (and the config watcher) only ever see the old or the new file
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+class Config(dict):
+    # settings.json merged over default_config. Invalid values are reported
+    # and replaced by their default. A file that doesn't parse (half written,
+    # or a typo) is never overwritten: a reload keeps the current config, and
+    # at startup the last good copy (settings.json.bak) is used instead.
+    # Top-level values are replaced, never mutated, so readers on other
+    # threads always see a consistent section.
+    def __init__(self, path, defaults):
+        super().__init__()
+        self.path = path
+        self.backup_path = path + ".bak"
+        self.defaults = defaults
+        self.good = None
+        self.errors = []
+        self.lock = threading.RLock()
+
+    def read(self, path=None):
+        with open(path or self.path, "r") as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError("the top level is not a JSON object")
+        return data
+
+    def load(self):
+        # (Re)read the file; returns the top-level keys whose values changed
+        with self.lock:
+            try:
+                data = self.read()
+            except FileNotFoundError:
+                data = {}
+                write_json_atomic(self.path, self.defaults)
+            except (OSError, ValueError) as e:
+                print(f"[ERROR] Could not read {self.path}: {e}")
+                logging.error(f"Could not read {self.path}: {e}")
+                if self:
+                    logging.info("Keeping the current settings.")
+                    return set()
+                data = self.last_good()
+            else:
+                self.remember(data)
+            valid, errors = validate_settings(data, self.defaults)
+            for error in errors:
+                if error not in self.errors:
+                    print(f"[ERROR] Invalid setting, using the default: {error}")
+                    logging.error(f"Invalid setting, using the default: {error}")
+            self.errors = errors
+            merged = merge_settings(copy.deepcopy(self.defaults), valid)
+            changed = {key for key in set(merged) | set(self) if merged.get(key) != self.get(key)}
+            for key in changed:
+                if key in merged:
+                    self[key] = merged[key]
+                else:
+                    del self[key]
+            return changed
+
+    def last_good(self):
+        try:
+            data = self.read(self.backup_path)
+            logging.info(f"Using the last good settings from {self.backup_path}")
+            self.good = data
+            return data
+        except (OSError, ValueError):
+            return {}
+
+    def remember(self, data):
+        if self.good is None:
+            try:
+                self.good = self.read(self.backup_path)
+            except (OSError, ValueError):
+                pass
+        if data != self.good:
+            self.good = data
+            try:
+                write_json_atomic(self.backup_path, data)
+            except OSError as e:
+                logging.error(f"Could not write {self.backup_path}: {e}")
+
+    def save(self, changes):
+        # Merge changes into the file's own settings (defaults stay implicit)
+        # and write it atomically; returns the changed top-level keys
+        with self.lock:
+            try:
+                data = self.read()
+            except FileNotFoundError:
+                data = {}
+            except (OSError, ValueError):
+                data = copy.deepcopy(self.good or {})
+            write_json_atomic(self.path, merge_settings(data, changes))
+            return self.load()
+
+
+class ConfigWatcher:
+    # Calls a file's callback when the file is written or replaced. inotify
+    # watches the parent directories, since editors and write_json_atomic
+    # replace files by rename, which a watch on the file itself would lose;
+    # where inotify isn't available mtimes are polled instead. Events are
+    # debounced so an editor's several writes cause one reload.
+    IN_CLOSE_WRITE = 0x08
+    IN_MOVED_TO = 0x80
+
+    def __init__(self, debounce=0.2, poll_interval=1.0):
+        self.callbacks = {}
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.libc = None
+        self.fd = None
+        self.dirs = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def watch(self, path, callback):
+        path = os.path.abspath(os.path.expanduser(path))
+        with self.lock:
+            self.callbacks[path] = callback
+            if self.fd is not None:
+                self._add_watch(os.path.dirname(path))
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="config-watcher", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            self._open_inotify()
+        except (OSError, AttributeError) as e:
+            logging.info(f"inotify unavailable ({e}), polling settings files every {self.poll_interval}s")
+            self._poll()
+            return
+        self._read_events()
+
+    def _open_inotify(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError("not Linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        with self.lock:
+            self.libc, self.fd = libc, fd
+            for path in self.callbacks:
+                self._add_watch(os.path.dirname(path))
+
+    def _add_watch(self, directory):
+        if directory in self.dirs.values() or not os.path.isdir(directory):
+            return
+        wd = self.libc.inotify_add_watch(self.fd, directory.encode(), self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+        if wd < 0:
+            logging.error(f"Could not watch {directory}: {os.strerror(ctypes.get_errno())}")
+        else:
+            self.dirs[wd] = directory
+
+    def _read_events(self):
+        while True:
+            changed = self._parse(os.read(self.fd, 65536))
+            while select.select([self.fd], [], [], self.debounce)[0]:
+                changed |= self._parse(os.read(self.fd, 65536))
+            for path in changed:
+                self._notify(path)
+
+    def _parse(self, data):
+        # struct inotify_event: int wd, uint32 mask, cookie, len, char name[len]
+        changed = set()
+        pos = 0
+        while pos + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, pos)
+            name = data[pos + 16:pos + 16 + length].split(b"\0", 1)[0].decode(errors="replace")
+            pos += 16 + length
+            path = os.path.join(self.dirs.get(wd, ""), name)
+            if path in self.callbacks:
+                changed.add(path)
+        return changed
+
+    def _poll(self):
+        stamps = {}
+        while True:
+            for path in list(self.callbacks):
+                try:
+                    st = os.stat(path)
+                    stamp = (st.st_mtime_ns, st.st_size)
+                except OSError:
+                    stamp = None
+                if path in stamps and stamp is not None and stamp != stamps[path]:
+                    self._notify(path)
+                stamps[path] = stamp
+            time.sleep(self.poll_interval)
+
+    def _notify(self, path):
+        try:
+            self.callbacks[path]()
+        except Exception as e:
+            logging.error(f"Reloading {path} failed: {e}")
+            print(f"[ERROR] Reloading {path} failed: {e}")
+
+
+log_path = os.path.expanduser("~/.local/share/whisper-dictation.log")
+os.makedirs(os.path.dirname(log_path), exist_ok=True)
+logging.basicConfig(filename=log_path, level=logging.INFO, format="%(asctime)s %(message)s")
+
+config = Config(config_path, default_config)
+config.load()
+
+startup_mode = config.get("startup_mode", "dictation")
+startup_listening = config.get("startup_listening", "asleep")
+mode = startup_mode
+listening = startup_listening == "awake"
+
+sample_rate = 16000
+
+
+class EventBus:
+    # Publish/subscribe between the audio, ASR and command threads and the UI.
+    # Callbacks run on the publishing thread; the Qt side re-emits them as
+    # signals (QtBridge) so widgets are only touched on the GUI thread.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = collections.defaultdict(list)
+        self.state = {}
+
+    def subscribe(self, topic, callback):
+        with self.lock:
+            self.subscribers[topic].append(callback)
+
+    def unsubscribe(self, topic, callback):
+        with self.lock:
+            if callback in self.subscribers[topic]:
+                self.subscribers[topic].remove(callback)
+
+    def has_subscribers(self, topic):
+        return bool(self.subscribers.get(topic))
+
+    def publish(self, topic, data=None):
+        with self.lock:
+            callbacks = list(self.subscribers.get(topic, ()))
+        for callback in callbacks:
+            try:
+                callback(topic, data)
+            except Exception as e:
+                logging.error(f"Event handler for '{topic}' failed: {e}")
+
+    def set_state(self, **changes):
+        # Publishes a "state" event only for values that actually changed
+        with self.lock:
+            changed = {k: v for k, v in changes.items() if self.state.get(k) != v}
+            self.state.update(changed)
+        if changed:
+            self.publish("state", changed)
+
+
+bus = EventBus()
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class Metrics:
+    # Rolling windows of observations plus counters and gauges, keyed by
+    # metric name and label set. Read by the Prometheus endpoint, the JSONL
+    # exporter and the Debug window.
+    quantiles = (0.5, 0.9, 0.95, 0.99)
+
+    def __init__(self, window=500):
+        self.lock = threading.Lock()
+        self.series = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.counts = collections.Counter()
+        self.sums = collections.Counter()
+        self.counters = collections.Counter()
+        self.gauges = {}
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.series[key].append(value)
+            self.counts[key] += 1
+            self.sums[key] += value
+
+    def inc(self, name, n=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += n
+
+    def gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def percentiles(self, name, **labels):
+        with self.lock:
+            values = sorted(self.series.get((name, tuple(sorted(labels.items()))), ()))
+        return {q: percentile(values, q) for q in self.quantiles}
+
+    def summary(self):
+        with self.lock:
+            series = {key: sorted(values) for key, values in self.series.items()}
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        out = {}
+        for (name, labels), values in series.items():
+            label = name + "".join(f",{k}={v}" for k, v in labels)
+            out[label] = {f"p{int(q * 100)}": percentile(values, q) for q in self.quantiles}
+            out[label]["n"] = len(values)
+        for (name, labels), value in list(counters.items()) + list(gauges.items()):
+            out[name + "".join(f",{k}={v}" for k, v in labels)] = value
+        return out
+
+    def prometheus_text(self):
+        def fmt(labels, extra=()):
+            items = list(labels) + list(extra)
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}" if items else ""
+
+        with self.lock:
+            series = {key: sorted(values) for key, values in self.series.items()}
+            counts = dict(self.counts)
+            sums = dict(self.sums)
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        lines = []
+        for name in sorted({name for name, _ in series}):
+            lines.append(f"# TYPE dictation_{name} summary")
+            for (n, labels), values in series.items():
+                if n != name:
+                    continue
+                for q in self.quantiles:
+                    lines.append(f"dictation_{name}{fmt(labels, [('quantile', q)])} {percentile(values, q)}")
+                lines.append(f"dictation_{name}_sum{fmt(labels)} {sums[(n, labels)]}")
+                lines.append(f"dictation_{name}_count{fmt(labels)} {counts[(n, labels)]}")
+        for kind, values in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({name for name, _ in values}):
+                lines.append(f"# TYPE dictation_{name} {kind}")
+                for (n, labels), value in values.items():
+                    if n == name:
+                        lines.append(f"dictation_{name}{fmt(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics(config.get("metrics", {}).get("window", 500))
+
+
+class ASREngine:
+    # Common interface for speech recognisers. transcribe() takes a float32
+    # mono 16 kHz array and returns a list of segment dicts with "start",
+    # "end", "text", "tokens", "avg_logprob" and "no_speech_prob" keys.
+    name = None
+    supports_hotwords = False
+
+    def __init__(self, model_size="small", device="auto", fp16=False, beam_size=1, **options):
+        self.model_size = model_size
+        self.device = device
+        self.fp16 = fp16
+        self.beam_size = beam_size
+        self.options = options
+        self.model = None
+
+    def load(self):
+        raise NotImplementedError
+
+    def transcribe(self, audio, language="en", initial_prompt=None, **options):
+        raise NotImplementedError
+
+    def encode_prompt(self, text):
+        # Token ids for text, if initial_prompt accepts pre-tokenized prompts
+        return None
+
+    def warm_up(self):
+        self.transcribe(np.zeros(sample_rate, dtype=np.float32), language="en")
+
+    def describe(self):
+        return f"{self.name}:{self.model_size}@{self.device}"
+
+
+class WhisperEngine(ASREngine):
+    # Reference engine: openai-whisper on PyTorch.
+    name = "whisper"
+
+    def load(self):
+        # Imported here so clients of the daemon never pay for torch
+        try:
+            import whisper
+            import torch
+        except ImportError:
+            raise RuntimeError("openai-whisper is not installed (pip install openai-whisper)")
+        if self.device == "auto":
+            self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        if self.fp16 and self.device == "cpu":
+            logging.warning("FP16 requested but the model is on CPU; using FP32.")
+            self.fp16 = False
+        precision = "FP16" if self.fp16 else "FP32"
+        logging.info(f"Loading Whisper model '{self.model_size}' in {precision} on {self.device.upper()}.")
+        model = whisper.load_model(self.model_size, device=self.device)
+        self.model = model.half() if self.fp16 else model.to(dtype=torch.float32)
+
+    def transcribe(self, audio, language="en", initial_prompt=None, **options):
+        if self.beam_size > 1:
+            options.setdefault("beam_size", self.beam_size)
+        if "max_tokens" in options:
+            options["sample_len"] = options.pop("max_tokens")
+        result = self.model.transcribe(audio, language=language, initial_prompt=initial_prompt, fp16=self.fp16, **options)
+        return [
+            {
+                "start": seg["start"],
+                "end": seg["end"],
+                "text": seg["text"],
+                "tokens": seg["tokens"],
+                "avg_logprob": seg["avg_logprob"],
+                "no_speech_prob": seg["no_speech_prob"],
+            }
+            for seg in result["segments"]
+        ]
+
+    def encode(self, audio):
+        # Encoder output for up to 30 s of audio, for any number of decode()s
+        import whisper
+        import torch
+        mel = whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), self.model.dims.n_mels, device=self.model.device)
+        with torch.no_grad():
+            return self.model.embed_audio((mel.half() if self.fp16 else mel)[None])
+
+    def decode(self, features, duration, language="en", initial_prompt=None, beam_size=None, max_tokens=None,
+               temperature=0.0, **options):
+        # One pass over encode() output (one window, no timestamps); whisper
+        # skips its encoder when given features instead of a spectrogram
+        import whisper
+        beam_size = beam_size or self.beam_size
+        result = whisper.decode(self.model, features, whisper.DecodingOptions(
+            language=language, prompt=initial_prompt, beam_size=beam_size if beam_size > 1 else None,
+            sample_len=max_tokens, temperature=temperature, without_timestamps=True, fp16=self.fp16))[0]
+        return [{"start": 0.0, "end": duration, "text": result.text, "tokens": result.tokens,
+                 "avg_logprob": result.avg_logprob, "no_speech_prob": result.no_speech_prob}]
+
+
+class FasterWhisperEngine(ASREngine):
+    # CTranslate2 backend; int8 weights make it several times faster than
+    # FP32 PyTorch on CPU-only machines.
+    name = "faster-whisper"
+
+    def load(self):
+        try:
+            import faster_whisper
+        except ImportError:
+            raise RuntimeError("faster-whisper is not installed (pip install faster-whisper)")
+        if self.device == "auto":
+            import ctranslate2
+            self.device = "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+        compute_type = self.options.get("compute_type", "int8")
+        if self.fp16 and self.device == "cuda" and compute_type == "int8":
+            compute_type = "int8_float16"
+        logging.info(f"Loading faster-whisper model '{self.model_size}' ({compute_type}) on {self.device.upper()}.")
+        self.model = faster_whisper.WhisperModel(
+            self.model_size,
+            device=self.device,
+            compute_type=compute_type,
+            cpu_threads=int(self.options.get("cpu_threads", 0)),
+            # Decodes that may run concurrently from different threads (batch mode)
+            num_workers=int(self.options.get("num_workers", 1)),
+        )
+        # hotwords arrived in faster-whisper 1.0
+        self.supports_hotwords = "hotwords" in inspect.signature(self.model.transcribe).parameters
+
+    def encode_prompt(self, text):
+        # Same encoding faster-whisper applies to a string prompt
+        return self.model.hf_tokenizer.encode(text, add_special_tokens=False).ids
+
+    def transcribe(self, audio, language="en", initial_prompt=None, **options):
+        options.setdefault("beam_size", self.beam_size)
+        if "max_tokens" in options:
+            options["max_new_tokens"] = options.pop("max_tokens")
+        segments, info = self.model.transcribe(audio, language=language, initial_prompt=initial_prompt, **options)
+        # segments is a lazy generator; decoding happens while we iterate
+        return [
+            {
+                "start": seg.start,
+                "end": seg.end,
+                "text": seg.text,
+                "tokens": list(seg.tokens),
+                "avg_logprob": seg.avg_logprob,
+                "no_speech_prob": seg.no_speech_prob,
+            }
+            for seg in segments
+        ]
+
+
+class CascadeEngine(ASREngine):
+    # Speculative decoding across model sizes: the fast model decodes every
+    # utterance and its result is kept when it is confident (and, in command
+    # mode, short); only the rest are decoded again by the main model. When
+    # both tiers are the same model the first pass is the configured decode
+    # and the second a wider beam search; with reuse_encoder the audio then
+    # goes through the encoder once for both.
+    name = "cascade"
+
+    def __init__(self, fast, main, settings):
+        super().__init__(model_size=f"{fast.model_size}>{main.model_size}", device=main.device)
+        self.fast = fast
+        self.main = main
+        self.model = main.model
+        self.min_avg_logprob = settings.get("min_avg_logprob", -0.5)
+        self.max_no_speech_prob = settings.get("max_no_speech_prob", 0.4)
+        self.command_max_words = int(settings.get("command_max_words", 6))
+        self.reuse_encoder = settings.get("reuse_encoder", True) and fast is main and hasattr(main, "encode")
+        self.escalate_options = {"beam_size": max(main.beam_size, 5)} if fast is main else {}
+        self.supports_hotwords = fast.supports_hotwords and main.supports_hotwords
+        self.main_rtf = None
+        self.stats = {"accepted": 0, "escalated": 0, "saved_ms": 0.0}
+        self.lock = threading.Lock()
+
+    def load(self):
+        pass
+
+    def warm_up(self):
+        # The fast tier was warmed by its own ModelManager. Warming the main
+        # model directly keeps this out of the escalation counts and seeds
+        # the latency-saved estimate.
+        start = time.perf_counter()
+        self.main.warm_up()
+        self.main_rtf = time.perf_counter() - start
+
+    def describe(self):
+        if self.fast is self.main:
+            return f"cascade:{self.main.describe()}"
+        return f"cascade:{self.fast.model_size}>{self.main.describe()}"
+
+    def encode_prompt(self, text):
+        # Tokenizers differ between tiers (tiny.en vs small), so each gets text
+        return self.main.encode_prompt(text) if self.fast is self.main else None
+
+    def confident(self, segments):
+        if not segments:
+            return False
+        avg_logprob = sum(seg["avg_logprob"] for seg in segments) / len(segments)
+        no_speech = max(seg["no_speech_prob"] for seg in segments)
+        if avg_logprob < self.min_avg_logprob or no_speech > self.max_no_speech_prob:
+            return False
+        return mode != "command" or len(segments_text(segments).split()) <= self.command_max_words
+
+    def transcribe(self, audio, language="en", initial_prompt=None, **options):
+        duration = len(audio) / sample_rate
+        if self.reuse_encoder and duration <= 30:
+            start = time.perf_counter()
+            features = self.main.encode(audio)
+            encode_s = time.perf_counter() - start
+
+            def decode(engine, **extra):
+                return engine.decode(features, duration, language=language, initial_prompt=initial_prompt,
+                                     **dict(options, **extra))
+        else:
+            encode_s = 0.0
+
+            def decode(engine, **extra):
+                return engine.transcribe(audio, language=language, initial_prompt=initial_prompt, **dict(options, **extra))
+
+        start = time.perf_counter()
+        segments = decode(self.fast)
+        fast_s = time.perf_counter() - start
+        if self.confident(segments):
+            result = "accepted"
+            # Against what the main model would have taken, at its running RTF
+            saved_s = self.main_rtf * duration - fast_s - encode_s if self.main_rtf is not None else None
+        else:
+            result = "escalated"
+            start = time.perf_counter()
+            segments = decode(self.main, **self.escalate_options)
+            main_s = time.perf_counter() - start + encode_s
+            with self.lock:
+                rtf = main_s / max(duration, 0.1)
+                self.main_rtf = rtf if self.main_rtf is None else 0.8 * self.main_rtf + 0.2 * rtf
+            saved_s = -fast_s
+        with self.lock:
+            self.stats[result] += 1
+            if saved_s is not None:
+                self.stats["saved_ms"] += saved_s * 1000
+        metrics.inc("cascade_total", result=result)
+        if saved_s is not None:
+            metrics.observe("cascade_saved_ms", saved_s * 1000)
+        return segments
+
+
+asr_engines = {"whisper": WhisperEngine, "faster-whisper": FasterWhisperEngine}
+
+
+def make_engine(settings, fp16=False):
+    name = settings.get("engine", "whisper")
+    if name not in asr_engines:
+        raise ValueError(f"Unknown ASR engine '{name}', expected one of {', '.join(asr_engines)}")
+    options = {k: v for k, v in settings.items() if k not in ("engine", "model", "device", "beam_size")}
+    return asr_engines[name](
+        model_size=settings.get("model", "small"),
+        device=settings.get("device", "auto"),
+        fp16=fp16,
+        beam_size=int(settings.get("beam_size", 1)),
+        **options,
+    )
+
+
+def segments_text(segments):
+    return "".join(seg["text"] for seg in segments).strip()
+
+
+class ModelManager:
+    # Owns the ASR engine. The model is loaded exactly once, on a background
+    # thread so the UI can come up immediately, followed by a warm-up decode.
+    # With cascade settings enabled the engine is a CascadeEngine whose fast
+    # tier comes from shared_models(), loading alongside the main model.
+    def __init__(self, settings, fp16=False, name="asr", cascade=None):
+        self.settings = settings
+        self.fp16 = fp16
+        self.name = name
+        self.cascade = cascade or {}
+        self.engine = None
+        self.error = None
+        self.state = "idle"
+        self.metrics = {}
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._load, name="model-loader", daemon=True)
+                self.thread.start()
+
+    def _load(self):
+        try:
+            self.set_state("loading")
+            start = time.perf_counter()
+            fast_models = None
+            fast_model = self.cascade.get("fast_model", "tiny.en")
+            if self.cascade.get("enabled", False) and fast_model != self.settings.get("model", "small"):
+                fast_models = shared_models(dict(self.settings, model=fast_model, beam_size=1), self.fp16, name="fast")
+                fast_models.start()
+            eng = make_engine(self.settings, self.fp16)
+            eng.load()
+            if self.cascade.get("enabled", False):
+                try:
+                    fast = fast_models.get() if fast_models is not None else eng
+                    eng = CascadeEngine(fast, eng, self.cascade)
+                except RuntimeError as e:
+                    logging.error(f"Cascade disabled, fast model unavailable: {e}")
+            self.metrics["load_seconds"] = time.perf_counter() - start
+            metrics.gauge("model_load_seconds", self.metrics["load_seconds"], model=self.name)
+            logging.info(f"Model {eng.describe()} loaded in {self.metrics['load_seconds']:.2f}s")
+
+            self.set_state("warming up")
+            start = time.perf_counter()
+            eng.warm_up()
+            self.metrics["first_inference_seconds"] = time.perf_counter() - start
+            metrics.gauge("model_first_inference_seconds", self.metrics["first_inference_seconds"], model=self.name)
+            logging.info(f"Warm-up inference took {self.metrics['first_inference_seconds']:.2f}s")
+
+            self.engine = eng
+            self.set_state("ready")
+        except Exception as e:
+            self.error = e
+            self.set_state("failed")
+            logging.error(f"Model loading failed: {e}")
+            print(f"[ERROR] Model loading failed: {e}")
+        finally:
+            self.ready.set()
+
+    def set_state(self, state):
+        self.state = state
+        bus.publish("model", {"name": self.name, "state": state, **self.metrics})
+
+    def get(self, timeout=None):
+        self.start()
+        if not self.ready.wait(timeout):
+            return None
+        if self.engine is None:
+            raise RuntimeError(f"ASR model failed to load: {self.error}")
+        return self.engine
+
+
+# One ModelManager, and so one loaded copy, per distinct engine config:
+# the command recognizer, the wake word and the cascade's fast tier share
+# the small model when their settings agree
+model_managers = weakref.WeakValueDictionary()
+
+
+def shared_models(settings, fp16=False, name="asr"):
+    key = json.dumps([settings, fp16], sort_keys=True)
+    manager = model_managers.get(key)
+    if manager is None:
+        manager = ModelManager(settings, fp16=fp16, name=name)
+        model_managers[key] = manager
+    return manager
+
+
+models = ModelManager(config.get("asr", {}), fp16=config.get("use_fp16", False), cascade=config.get("cascade", {}))
+
+audio_config = config.get("audio", {})
+block_size = int(sample_rate * audio_config.get("block_ms", 100) / 1000)
+ring_seconds = audio_config.get("ring_seconds", 30)
+
+# Spoken key names -> pynput Key attribute names. Injectors translate these
+# names to their own key codes, so the rest of the code only uses names.
+key_map = {
+    "ctrl": "ctrl",
+    "alt": "alt",
+    "shift": "shift",
+    "super": "cmd",
+    "delete": "delete",
+    "backspace": "backspace",
+    "tab": "tab",
+    "enter": "enter",
+    "escape": "esc",
+    "space": "space",
+    "home": "home",
+    "end": "end",
+    "left": "left",
+    "right": "right",
+    "up": "up",
+    "down": "down",
+}
+
+nato_map = {
+    "alpha": "a", "bravo": "b", "charlie": "c", "delta": "d", "echo": "e", "foxtrot": "f",
+    "golf": "g", "hotel": "h", "india": "i", "juliett": "j", "kilo": "k", "lima": "l",
+    "mike": "m", "november": "n", "oscar": "o", "papa": "p", "quebec": "q", "romeo": "r",
+    "sierra": "s", "tango": "t", "uniform": "u", "victor": "v", "whiskey": "w",
+    "x-ray": "x", "yankee": "y", "zulu": "z"
+}
+spoken_aliases = {'semicolon': ';', 'colon': ':', 'comma': ',', 'period': '.', 'dot': '.', 'slash': '/', 'backslash': '\\', 'quote': "'", 'double quote': '"', 'apostrophe': "'", 'dash': '-', 'minus': '-', 'equals': '=', 'plus': '+', 'underscore': '_', 'tilde': '~', 'grave': '`', 'backtick': '`', 'exclamation': '!', 'at': '@', 'hash': '#', 'pound': '#', 'dollar': '$', 'percent': '%', 'caret': '^', 'ampersand': '&', 'asterisk': '*', 'star': '*', 'pipe': '|', 'open bracket': '[', 'close bracket': ']', 'open brace': '{', 'close brace': '}', 'open paren': '(', 'close paren': ')', 'less than': '<', 'greater than': '>', 'question mark': '?'}
+
+
+class RateLimiter:
+    # Paces synthetic input to at most `rate` events per second so target
+    # applications don't drop keystrokes.
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_time = 0.0
+
+    def wait(self, events=1):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self.next_time > now:
+            time.sleep(self.next_time - now)
+        self.next_time = max(now, self.next_time) + events * self.interval
+
+
+class Injector:
+    # Keyboard/mouse output. Keys are spoken names from key_map or single
+    # characters; backends override the primitives and may batch sequences.
+    # Dry-run backends log app launches/closes instead of running them.
+    name = None
+    dry_run = False
+
+    def __init__(self, settings):
+        self.rate = float(settings.get("events_per_second", 400))
+        self.limiter = RateLimiter(self.rate)
+        self.paste_threshold = int(settings.get("paste_threshold", 200))
+        self.paste_keys = parse_key_combo(settings.get("paste_keys", "ctrl v"))
+
+    def count(self, events):
+        # Synthetic input events sent (or, dry-run, that would have been)
+        metrics.inc("injected_events_total", events, backend=self.name)
+
+    def type_text(self, text):
+        if self.paste_threshold and len(text) >= self.paste_threshold and clipboard_available():
+            self.paste(text)
+        else:
+            self._type(text)
+
+    def paste(self, text):
+        previous = get_clipboard()
+        set_clipboard(text)
+        self.press_keys(self.paste_keys)
+        if previous is not None:
+            # Give the target app time to read the clipboard before restoring it
+            threading.Timer(0.5, self._restore_clipboard, args=(previous,)).start()
+
+    def _restore_clipboard(self, previous):
+        try:
+            set_clipboard(previous)
+        except Exception as e:
+            print(f"[ERROR] Failed to restore the clipboard: {e}")
+            logging.error(f"Failed to restore the clipboard: {e}")
+
+    def _type(self, text):
+        raise NotImplementedError
+
+    def press_keys(self, keys):
+        raise NotImplementedError
+
+    def key_sequence(self, combos):
+        for combo in combos:
+            self.press_keys(combo)
+
+    def tap(self, key, count=1, modifiers=()):
+        self.key_sequence([list(modifiers) + [key]] * count)
+
+    def key_down(self, key):
+        raise NotImplementedError
+
+    def key_up(self, key):
+        raise NotImplementedError
+
+    def mouse_move(self, dx, dy):
+        raise NotImplementedError
+
+    def click(self, button="left", count=1):
+        raise NotImplementedError
+
+    def scroll(self, dy):
+        raise NotImplementedError
+
+    def mouse_down(self, button="left"):
+        raise NotImplementedError
+
+    def mouse_up(self, button="left"):
+        raise NotImplementedError
+
+
+class PynputInjector(Injector):
+    # One synthetic event per call (X11 or Windows), paced by the rate limiter
+    name = "pynput"
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        import pynput.keyboard
+        import pynput.mouse
+        self.Key = pynput.keyboard.Key
+        self.Button = pynput.mouse.Button
+        self.kb = pynput.keyboard.Controller()
+        self.mouse = pynput.mouse.Controller()
+
+    def _key(self, name):
+        return getattr(self.Key, key_map[name]) if name in key_map else name
+
+    def _type(self, text):
+        for char in text:
+            self.limiter.wait()
+            self.kb.type(char)
+        self.count(len(text))
+
+    def press_keys(self, keys):
+        keys = [self._key(k) for k in keys]
+        self.limiter.wait(len(keys))
+        for k in keys:
+            self.kb.press(k)
+        for k in reversed(keys):
+            self.kb.release(k)
+        self.count(len(keys))
+
+    def key_down(self, key):
+        self.kb.press(self._key(key))
+        self.count(1)
+
+    def key_up(self, key):
+        self.kb.release(self._key(key))
+
+    def mouse_move(self, dx, dy):
+        self.mouse.move(dx, dy)
+
+    def click(self, button="left", count=1):
+        self.mouse.click(getattr(self.Button, button), count)
+        self.count(count)
+
+    def scroll(self, dy):
+        self.mouse.scroll(0, dy)
+
+    def mouse_down(self, button="left"):
+        self.mouse.press(getattr(self.Button, button))
+
+    def mouse_up(self, button="left"):
+        self.mouse.release(getattr(self.Button, button))
+
+
+xdotool_keys = {
+    "ctrl": "ctrl", "alt": "alt", "shift": "shift", "super": "super", "delete": "Delete",
+    "backspace": "BackSpace", "tab": "Tab", "enter": "Return", "escape": "Escape", "space": "space",
+    "home": "Home", "end": "End", "left": "Left", "right": "Right", "up": "Up", "down": "Down",
+    ",": "comma", ".": "period", "/": "slash", ";": "semicolon", "'": "apostrophe", "-": "minus",
+    "=": "equal", "[": "bracketleft", "]": "bracketright", "\\": "backslash", "`": "grave",
+}
+
+
+class XdotoolInjector(Injector):
+    # X11 bulk path: a whole string or key sequence goes to one xdotool call,
+    # which replays it through XTest with xdotool's own inter-key delay.
+    name = "xdotool"
+    buttons = {"left": "1", "middle": "2", "right": "3"}
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.delay = str(max(1, int(1000 / self.rate))) if self.rate else "0"
+
+    def _run(self, *args, text=None):
+        subprocess.run(["xdotool", *args], input=text.encode() if text is not None else None,
+                       check=True, timeout=30)
+
+    def _key(self, name):
+        return xdotool_keys.get(name, name)
+
+    def _type(self, text):
+        self._run("type", "--delay", self.delay, "--file", "-", text=text)
+        self.count(len(text))
+
+    def press_keys(self, keys):
+        self.key_sequence([keys])
+
+    def key_sequence(self, combos):
+        self._run("key", "--delay", self.delay, *["+".join(self._key(k) for k in combo) for combo in combos])
+        self.count(sum(len(combo) for combo in combos))
+
+    def tap(self, key, count=1, modifiers=()):
+        combo = "+".join(self._key(k) for k in list(modifiers) + [key])
+        self._run("key", "--repeat", str(count), "--delay", self.delay, combo)
+        self.count(count * (len(modifiers) + 1))
+
+    def key_down(self, key):
+        self._run("keydown", self._key(key))
+        self.count(1)
+
+    def key_up(self, key):
+        self._run("keyup", self._key(key))
+
+    def mouse_move(self, dx, dy):
+        self._run("mousemove_relative", "--", str(dx), str(dy))
+
+    def click(self, button="left", count=1):
+        self._run("click", "--repeat", str(count), self.buttons[button])
+        self.count(count)
+
+    def scroll(self, dy):
+        self._run("click", "--repeat", str(abs(dy)), "4" if dy > 0 else "5")
+
+    def mouse_down(self, button="left"):
+        self._run("mousedown", self.buttons[button])
+
+    def mouse_up(self, button="left"):
+        self._run("mouseup", self.buttons[button])
+
+
+# Linux input event codes (linux/input-event-codes.h) for ydotool
+evdev_keys = {
+    "ctrl": 29, "alt": 56, "shift": 42, "super": 125, "delete": 111, "backspace": 14, "tab": 15,
+    "enter": 28, "escape": 1, "space": 57, "home": 102, "end": 107, "left": 105, "right": 106,
+    "up": 103, "down": 108, "-": 12, "=": 13, "[": 26, "]": 27, ";": 39, "'": 40, "`": 41,
+    "\\": 43, ",": 51, ".": 52, "/": 53,
+}
+evdev_keys.update(zip("1234567890", range(2, 12)))
+evdev_keys.update(zip("qwertyuiop", range(16, 26)))
+evdev_keys.update(zip("asdfghjkl", range(30, 39)))
+evdev_keys.update(zip("zxcvbnm", range(44, 51)))
+
+
+class YdotoolInjector(Injector):
+    # Wayland bulk path through ydotool's uinput device (ydotoold must run)
+    name = "ydotool"
+    buttons = {"left": "0xC0", "right": "0xC1", "middle": "0xC2"}
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.delay = str(max(1, int(1000 / self.rate))) if self.rate else "0"
+
+    def _run(self, *args, text=None):
+        subprocess.run(["ydotool", *args], input=text.encode() if text is not None else None,
+                       check=True, timeout=30)
+
+    def _type(self, text):
+        self._run("type", "--key-delay", self.delay, "--file", "-", text=text)
+        self.count(len(text))
+
+    def press_keys(self, keys):
+        self.key_sequence([keys])
+
+    def key_sequence(self, combos):
+        events = []
+        for combo in combos:
+            codes = [evdev_keys[k] for k in combo]
+            events += [f"{c}:1" for c in codes] + [f"{c}:0" for c in reversed(codes)]
+        self._run("key", "--key-delay", self.delay, *events)
+        self.count(sum(len(combo) for combo in combos))
+
+    def key_down(self, key):
+        self._run("key", f"{evdev_keys[key]}:1")
+        self.count(1)
+
+    def key_up(self, key):
+        self._run("key", f"{evdev_keys[key]}:0")
+
+    def mouse_move(self, dx, dy):
+        self._run("mousemove", "-x", str(dx), "-y", str(dy))
+
+    def click(self, button="left", count=1):
+        self._run("click", "--repeat", str(count), self.buttons[button])
+        self.count(count)
+
+    def scroll(self, dy):
+        self._run("mousemove", "--wheel", "-x", "0", "-y", str(dy))
+
+    def mouse_down(self, button="left"):
+        self._run("click", hex(int(self.buttons[button], 16) & 0x4F))
+
+    def mouse_up(self, button="left"):
+        self._run("click", hex(int(self.buttons[button], 16) & 0x8F))
+
+
+class RecordingInjector(Injector):
+    # Headless backend: records what would have been injected
+    name = "recording"
+    dry_run = True
+
+    def __init__(self, settings=None):
+        super().__init__(dict(settings or {}, events_per_second=0, paste_threshold=0))
+        self.log = []
+
+    def record(self, *event):
+        self.log.append(event)
+
+    def _type(self, text):
+        self.record("type", text)
+        self.count(len(text))
+
+    def press_keys(self, keys):
+        self.record("keys", tuple(keys))
+        self.count(len(keys))
+
+    def key_down(self, key):
+        self.record("key_down", key)
+        self.count(1)
+
+    def key_up(self, key):
+        self.record("key_up", key)
+
+    def mouse_move(self, dx, dy):
+        self.record("move", dx, dy)
+
+    def click(self, button="left", count=1):
+        self.record("click", button, count)
+        self.count(count)
+
+    def scroll(self, dy):
+        self.record("scroll", dy)
+
+    def mouse_down(self, button="left"):
+        self.record("mouse_down", button)
+
+    def mouse_up(self, button="left"):
+        self.record("mouse_up", button)
+
+
+class NullInjector(RecordingInjector):
+    # Headless backend for long runs: sends nothing and, unlike recording,
+    # keeps nothing, so the daemon's memory doesn't grow with every keystroke
+    name = "null"
+
+    def record(self, *event):
+        pass
+
+
+injectors = {
+    "pynput": PynputInjector,
+    "xdotool": XdotoolInjector,
+    "ydotool": YdotoolInjector,
+    "recording": RecordingInjector,
+    "null": NullInjector,
+}
+
+
+def clipboard_command(action):
+    # (copy, paste) command lines for whichever clipboard tool is installed
+    if os.environ.get("WAYLAND_DISPLAY") and shutil.which("wl-copy"):
+        return {"set": ["wl-copy"], "get": ["wl-paste", "--no-newline"]}[action]
+    if shutil.which("xclip"):
+        return {"set": ["xclip", "-selection", "clipboard"], "get": ["xclip", "-o", "-selection", "clipboard"]}[action]
+    if shutil.which("xsel"):
+        return {"set": ["xsel", "--clipboard", "--input"], "get": ["xsel", "--clipboard", "--output"]}[action]
+    return None
+
+
+def clipboard_available():
+    return clipboard_command("set") is not None
+
+
+def get_clipboard():
+    cmd = clipboard_command("get")
+    try:
+        return subprocess.run(cmd, capture_output=True, check=True, timeout=2).stdout.decode()
+    except Exception:
+        return None
+
+
+def set_clipboard(text):
+    subprocess.run(clipboard_command("set"), input=text.encode(), check=True, timeout=2)
+
+
+def make_injector(settings):
+    backend = settings.get("backend", "auto")
+    if backend == "auto":
+        if sys.platform.startswith("linux") and os.environ.get("WAYLAND_DISPLAY") and shutil.which("ydotool"):
+            backend = "ydotool"
+        elif sys.platform.startswith("linux") and os.environ.get("DISPLAY") and shutil.which("xdotool"):
+            backend = "xdotool"
+        else:
+            backend = "pynput"
+    logging.info(f"Using {backend} input injection.")
+    return injectors[backend](settings)
+
+
+injector = None
+
+
+def get_injector():
+    global injector
+    if injector is None:
+        injector = make_injector(config.get("injection", {}))
+    return injector
+
+
+def set_injector(new_injector):
+    global injector
+    injector = new_injector
+
+
+held_keys = set()
+mouse_held = False
+last_transcript = ""
+typed_chars = 0  # running count of characters typed; the journal diffs it per utterance
+
+def type_text(text):
+    global typed_chars
+    try:
+        get_injector().type_text(text)
+        typed_chars += len(text)
+    except Exception as e:
+        print(f"[ERROR] Typing failed: {e}")
+        logging.error(f"Typing failed: {e}")
+
+def parse_key_combo(text):
+    return text.strip().lower().split()
+
+def press_keys(keys):
+    try:
+        get_injector().press_keys(keys)
+    except Exception as e:
+        print(f"[ERROR] Keypress failed: {e}")
+
+def hold_key(key_name):
+    if key_name not in held_keys:
+        try:
+            get_injector().key_down(key_name)
+            held_keys.add(key_name)
+            bus.set_state(held_keys=sorted(held_keys))
+        except Exception as e:
+            print(f"[ERROR] Failed to hold {key_name}: {e}")
+
+def release_all_keys():
+    for k in list(held_keys):
+        try:
+            get_injector().key_up(k)
+        except:
+            pass
+    held_keys.clear()
+    bus.set_state(held_keys=[])
+
+
+def normalize_process_name(name):
+    name = name.strip().lower()
+    return name[:-4] if name.endswith(".exe") else name
+
+
+def app_process_names(app_name):
+    # Executable names an app may run under: the spoken name and its alias target
+    names = {normalize_process_name(app_name)}
+    target = config.get("app_aliases", {}).get(app_name)
+    if target:
+        names.add(normalize_process_name(os.path.basename(target)))
+    return names
+
+
+class ProcessIndex:
+    # Exact name -> PIDs index for `close <app>`. It is kept current by diffing
+    # the PID list (a /proc listing on Linux) at most once per ttl; new PIDs
+    # are opened and named, known ones re-checked so a recycled PID or a
+    # process that exec()ed into another program is re-keyed. Processes
+    # started by launch_app are tracked separately and preferred.
+    def __init__(self, ttl=2.0, list_pids=psutil.pids, open_process=psutil.Process):
+        self.ttl = ttl
+        self.list_pids = list_pids
+        self.open_process = open_process
+        self.lock = threading.Lock()
+        self.procs = {}
+        self.names = {}
+        self.by_name = collections.defaultdict(set)
+        self.launched = collections.defaultdict(list)
+        self.refreshed = None
+
+    def _drop(self, pid):
+        del self.procs[pid]
+        name = self.names.pop(pid)
+        self.by_name[name].discard(pid)
+        if not self.by_name[name]:
+            del self.by_name[name]
+
+    def _add(self, pid, proc=None):
+        try:
+            proc = proc or self.open_process(pid)
+            name = normalize_process_name(proc.name())
+        except (psutil.Error, OSError):
+            return
+        self.procs[pid] = proc
+        self.names[pid] = name
+        self.by_name[name].add(pid)
+
+    def _current(self, pid):
+        # The cached entry if it still names the same process, else None.
+        # is_running() compares create times, so a reused PID fails it.
+        proc = self.procs[pid]
+        try:
+            if proc.is_running() and normalize_process_name(proc.name()) == self.names[pid]:
+                return proc
+        except (psutil.Error, OSError):
+            pass
+        return None
+
+    def _recheck(self, pid):
+        proc = self.procs[pid]
+        if self._current(pid) is not None:
+            return
+        self._drop(pid)
+        try:
+            running = proc.is_running()
+        except (psutil.Error, OSError):
+            running = False
+        # Same process under a new name (exec) keeps its handle; a recycled
+        # PID is opened again
+        self._add(pid, proc if running else None)
+
+    def refresh(self, force=False):
+        with self.lock:
+            if not force and self.refreshed is not None and time.monotonic() - self.refreshed < self.ttl:
+                return
+            pids = set(self.list_pids())
+            for pid in self.procs.keys() - pids:
+                self._drop(pid)
+            for pid in pids & self.procs.keys():
+                self._recheck(pid)
+            for pid in pids - self.procs.keys():
+                self._add(pid)
+            self.refreshed = time.monotonic()
+
+    def find(self, names):
+        self.refresh()
+        found = []
+        with self.lock:
+            for pid in [pid for name in names for pid in self.by_name.get(name, ())]:
+                # Re-checked at lookup too: the table can be up to ttl old
+                if self._current(pid) is not None:
+                    found.append(self.procs[pid])
+                else:
+                    self._recheck(pid)
+                    if self.names.get(pid) in names:
+                        found.append(self.procs[pid])
+        return found
+
+    def add_launched(self, app_name, proc):
+        with self.lock:
+            self.launched[normalize_process_name(app_name)].append(proc)
+
+    def find_launched(self, app_name):
+        key = normalize_process_name(app_name)
+        with self.lock:
+            # poll() also reaps launched apps that have exited on their own
+            self.launched[key] = [p for p in self.launched.get(key, ()) if p.poll() is None]
+            return list(self.launched[key])
+
+
+process_index = ProcessIndex()
+
+
+def launch_app(app_name: str):
+    # Look up alias first
+    target = config.get("app_aliases", {}).get(app_name, app_name)
+    if get_injector().dry_run:
+        get_injector().record("open", target)
+        return
+    try:
+        if sys.platform.startswith("win"):
+            # Use 'start' to resolve PATH / App Paths. cmd exits right away, so
+            # closing falls back to the name index.
+            proc = psutil.Popen(["cmd", "/c", "start", "", target], shell=False)
+        else:
+            # On POSIX, try launching directly (user can map aliases to full paths)
+            proc = psutil.Popen([target], shell=False)
+        process_index.add_launched(app_name, proc)
+        logging.info(f"Launched app: {target} (pid {proc.pid})")
+    except Exception as e:
+        logging.error(f"Failed to launch '{app_name}' -> {target}: {e}")
+        print(f"[ERROR] Failed to open {app_name}: {e}")
+
+def close_app(app_name: str):
+    if get_injector().dry_run:
+        get_injector().record("close", app_name)
+        return
+    # Apps we launched first; otherwise every process whose executable name
+    # is exactly the app name or its alias target
+    procs = process_index.find_launched(app_name) or process_index.find(app_process_names(app_name))
+    procs = [p for p in procs if p.pid != os.getpid()]
+    for p in procs:
+        try:
+            p.terminate()
+        except psutil.Error:
+            pass
+    # Fallback: force kill if still alive
+    gone, alive = psutil.wait_procs(procs, timeout=1)
+    for p in alive:
+        try:
+            p.kill()
+        except psutil.Error:
+            pass
+    if not procs:
+        print(f"[INFO] No running process matched '{app_name}'.")
+    else:
+        print(f"[INFO] Closed {len(procs)} process(es) for '{app_name}'.")
+
+
+number_words = {
+    "zero": 0, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8,
+    "nine": 9, "ten": 10, "eleven": 11, "twelve": 12, "thirteen": 13, "fourteen": 14, "fifteen": 15,
+    "sixteen": 16, "seventeen": 17, "eighteen": 18, "nineteen": 19, "twenty": 20,
+}
+mouse_directions = {"left": (-1, 0), "right": (1, 0), "up": (0, -1), "down": (0, 1)}
+
+# Argument slot types: each converts one token or returns None if it does not fit.
+# A trailing "..." in a pattern makes the slot take every remaining token.
+slot_types = {
+    "key": lambda t: t if t in key_map or len(t) == 1 else None,
+    "keyname": lambda t: t if t in key_map else None,
+    "count": lambda t: int(t) if t.isdigit() else number_words.get(t),
+    "direction": lambda t: t if t in mouse_directions else None,
+    "letter": lambda t: nato_map.get(t),
+    "word": lambda t: t,
+    "app": lambda t: t,
+}
+slot_examples = {
+    "key": "enter", "keyname": "ctrl", "count": "3", "direction": "left",
+    "letter": "alpha", "word": "hello", "app": "notepad",
+}
+
+
+class Slot:
+    def __init__(self, spec):
+        spec = spec[1:-1]
+        self.variadic = spec.endswith("...")
+        spec = spec[:-3] if self.variadic else spec
+        self.name, _, kind = spec.partition(":")
+        self.kind = kind or self.name
+        if self.kind not in slot_types:
+            raise ValueError(f"unknown slot type '{self.kind}'")
+        self.convert = slot_types[self.kind]
+        self.key = (self.name, self.kind, self.variadic)
+
+    def join(self, values):
+        if self.kind == "letter":
+            return "".join(values)
+        if self.kind == "app":
+            return " ".join(values)
+        return values
+
+
+class CommandNode:
+    def __init__(self):
+        self.literals = {}
+        self.slots = []
+        self.command = None
+
+    def slot_child(self, slot):
+        for existing, child in self.slots:
+            if existing.key == slot.key:
+                return child
+        child = CommandNode()
+        self.slots.append((slot, child))
+        return child
+
+
+class Command:
+    def __init__(self, pattern, handler, source="builtin"):
+        self.pattern = pattern
+        self.handler = handler
+        self.source = source
+        self.parts = [Slot(tok) if tok.startswith("{") else tok for tok in pattern.split()]
+        for part in self.parts[:-1]:
+            if isinstance(part, Slot) and part.variadic:
+                raise ValueError(f"'{pattern}': only the last slot can take several words")
+
+    def has_slots(self):
+        return any(isinstance(part, Slot) for part in self.parts)
+
+    def example(self):
+        words = []
+        for part in self.parts:
+            if isinstance(part, Slot):
+                words.append(slot_examples[part.kind])
+                if part.variadic and part.kind == "letter":
+                    words.append("bravo")
+            else:
+                words.append(part)
+        return " ".join(words)
+
+
+class CommandRegistry:
+    # Phrase patterns compiled into a token trie. Literal words win over
+    # slots at every position, so parsing is a walk over the tokens rather
+    # than a cascade of string tests.
+    def __init__(self):
+        self.root = CommandNode()
+        self.commands = []
+
+    def register(self, pattern, handler, source="builtin"):
+        command = Command(pattern, handler, source)
+        node = self.root
+        for part in command.parts:
+            if isinstance(part, Slot):
+                node = node.slot_child(part)
+            else:
+                node = node.literals.setdefault(part, CommandNode())
+        if node.command is not None:
+            self.commands.remove(node.command)
+            logging.info(f"Command '{pattern}' ({source}) replaces '{node.command.pattern}' ({node.command.source})")
+        node.command = command
+        self.commands.append(command)
+        return command
+
+    def parse(self, text):
+        # Returns (command, args) or None; text should already be normalized
+        tokens = text.split()
+        if not tokens:
+            return None
+        return self._match(self.root, tokens, 0, {})
+
+    def _match(self, node, tokens, i, args):
+        if i == len(tokens):
+            return (node.command, args) if node.command else None
+        child = node.literals.get(tokens[i])
+        if child is not None:
+            found = self._match(child, tokens, i + 1, args)
+            if found:
+                return found
+        for slot, child in node.slots:
+            if slot.variadic:
+                values = [slot.convert(t) for t in tokens[i:]]
+                if child.command and all(v is not None for v in values):
+                    return child.command, dict(args, **{slot.name: slot.join(values)})
+                continue
+            value = slot.convert(tokens[i])
+            if value is not None:
+                found = self._match(child, tokens, i + 1, dict(args, **{slot.name: value}))
+                if found:
+                    return found
+        return None
+
+    def dispatch(self, text):
+        found = self.parse(text)
+        if found is None:
+            return False
+        command, args = found
+        logging.debug(f"Command '{command.pattern}' {args}")
+        command.handler(**args)
+        return True
+
+
+def press_key(key):
+    try:
+        if len(key) == 1 and not key.isalnum():
+            get_injector().type_text(key)
+        else:
+            get_injector().press_keys([key])
+    except Exception as e:
+        print(f"[ERROR] Failed to press {key}: {e}")
+        logging.error(f"Failed to press {key}: {e}")
+
+
+def select_lines(count):
+    try:
+        get_injector().key_sequence([["home"], ["shift", "down"]] * count)
+    except Exception as e:
+        print(f"[ERROR] Failed to select line: {e}")
+        logging.error(f"Failed to select line: {e}")
+
+
+def select_word(word):
+    try:
+        inj = get_injector()
+        inj.tap("left", 100, modifiers=["ctrl"])
+        inj.tap("right", 100, modifiers=["shift"])
+    except Exception as e:
+        print(f"[ERROR] Failed to select word: {e}")
+        logging.error(f"Failed to select word: {e}")
+
+
+def move_mouse(direction, count=None):
+    amount = count if count is not None else int(config.get("mouse_step", 50))
+    dx, dy = mouse_directions[direction]
+    try:
+        get_injector().mouse_move(dx * amount, dy * amount)
+    except Exception as e:
+        print(f"[ERROR] Failed to move mouse: {e}")
+        logging.error(f"Failed to move mouse: {e}")
+
+
+def hold_click():
+    global mouse_held
+    try:
+        get_injector().mouse_down("left")
+        mouse_held = True
+    except Exception as e:
+        print(f"[ERROR] Failed to hold click: {e}")
+
+
+def release_click():
+    global mouse_held
+    try:
+        get_injector().mouse_up("left")
+        mouse_held = False
+    except Exception as e:
+        print(f"[ERROR] Failed to release click: {e}")
+
+
+def click(button, count=1):
+    try:
+        get_injector().click(button, count)
+    except Exception as e:
+        print(f"[ERROR] Failed to click: {e}")
+        logging.error(f"Failed to click: {e}")
+
+
+def scroll(amount):
+    try:
+        get_injector().scroll(amount)
+    except Exception as e:
+        print(f"[ERROR] Failed to scroll: {e}")
+        logging.error(f"Failed to scroll: {e}")
+
+
+def register_builtin_commands(registry):
+    r = registry.register
+    for phrase in control_phrases:
+        r(phrase, lambda phrase=phrase: apply_control(phrase))
+    for phrase in undo_phrases:
+        r(phrase, undo_last)
+    r("hold {key}", lambda key: hold_key(key))
+    r("press {key}", press_key)
+    r("release keys", release_all_keys)
+    r("select line {count}", select_lines)
+    r("select word {word}", select_word)
+    r("select all", lambda: press_keys(["ctrl", "a"]))
+    r("copy", lambda: press_keys(["ctrl", "c"]))
+    r("paste", lambda: press_keys(["ctrl", "v"]))
+    r("open {app...}", lambda app: launch_app(app))
+    r("close {app...}", lambda app: close_app(app))
+    r("{letters:letter...}", lambda letters: type_text(letters))
+    r("{key:keyname}", press_key)
+    r("{first:keyname} {rest:key...}", lambda first, rest: press_keys([first] + rest))
+    for phrase, symbol in spoken_aliases.items():
+        r(phrase, lambda symbol=symbol: press_key(symbol))
+    r("-", lambda: press_key("-"))
+    # "move mouse left 1000", "move mouse 1000 left", or no amount (uses settings)
+    r("move mouse {direction}", move_mouse)
+    r("move mouse {direction} {count}", move_mouse)
+    r("move mouse {count} {direction}", move_mouse)
+    r("click", lambda: click("left"))
+    r("double click", lambda: click("left", 2))
+    r("left click", lambda: click("left"))
+    r("left mouse click", lambda: click("left"))
+    r("left double click", lambda: click("left", 2))
+    r("double left click", lambda: click("left", 2))
+    r("right click", lambda: click("right"))
+    r("middle click", lambda: click("middle"))
+    r("scroll up", lambda: scroll(2))
+    r("scroll down", lambda: scroll(-2))
+    r("hold click", hold_click)
+    r("release click", release_click)
+
+
+# How deep "command" actions are nested on this thread; a user command that
+# runs itself, directly or through others, stops at max_command_depth
+command_expansion = threading.local()
+max_command_depth = 5
+
+
+def user_command_handler(entry, registry):
+    # A user command runs its actions in order; "{slot}" placeholders in the
+    # action values are filled from the spoken arguments.
+    actions = entry.get("actions") or [{k: entry[k]} for k in ("keys", "type", "open", "command") if k in entry]
+    for action in actions:
+        for kind in action:
+            if kind not in ("keys", "type", "open", "command"):
+                raise ValueError(f"unknown action '{kind}'")
+    if not actions:
+        raise ValueError("no action given")
+
+    def run(**args):
+        values = {k: " ".join(map(str, v)) if isinstance(v, list) else str(v) for k, v in args.items()}
+        for action in actions:
+            for kind, value in action.items():
+                value = value.format_map(values)
+                if kind == "keys":
+                    press_keys(parse_key_combo(value))
+                elif kind == "type":
+                    type_text(value)
+                elif kind == "open":
+                    launch_app(value)
+                elif kind == "command":
+                    depth = getattr(command_expansion, "depth", 0)
+                    if depth >= max_command_depth:
+                        print(f"[ERROR] User command '{entry['phrase']}' nests deeper than {max_command_depth} commands; skipping '{value}'")
+                        logging.error(f"User command '{entry['phrase']}' nests deeper than {max_command_depth} commands; skipping '{value}'")
+                        continue
+                    command_expansion.depth = depth + 1
+                    try:
+                        if not registry.dispatch(normalize_command(value)):
+                            logging.error(f"User command '{entry['phrase']}' expands to unknown command '{value}'")
+                    finally:
+                        command_expansion.depth = depth
+    return run
+
+
+def load_user_commands(registry, path):
+    try:
+        with open(path) as f:
+            entries = json.load(f).get("commands", [])
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError, AttributeError) as e:
+        logging.error(f"Could not read user commands from {path}: {e}")
+        print(f"[ERROR] Could not read user commands from {path}: {e}")
+        return 0
+    loaded = 0
+    for entry in entries:
+        try:
+            phrase = entry["phrase"].lower()
+            if "{" not in phrase:
+                phrase = normalize_command(phrase)
+            registry.register(phrase, user_command_handler(entry, registry), source=path)
+            loaded += 1
+        except (KeyError, ValueError, TypeError) as e:
+            logging.error(f"Skipping user command {entry!r}: {e}")
+            print(f"[ERROR] Skipping user command {entry!r}: {e}")
+    return loaded
+
+
+def commands_path():
+    return os.path.expanduser(config.get("commands_file", "~/.config/whisper-dictate/commands.json"))
+
+
+def build_command_registry():
+    registry = CommandRegistry()
+    register_builtin_commands(registry)
+    path = commands_path()
+    loaded = load_user_commands(registry, path)
+    if loaded:
+        logging.info(f"Loaded {loaded} user command(s) from {path}")
+    return registry
+
+
+def handle_command(text):
+    if not command_registry.dispatch(text):
+        logging.info(f"No command matched '{text}'")
+
+
+def normalize_command(text):
+    return re.sub(r"[^a-zA-Z0-9 -]+", "", text.strip().lower())
+
+
+def is_command(text):
+    return any(phrase in text for phrase in control_phrases) or command_registry.parse(text) is not None
+
+
+def command_phrases():
+    # Slot-free phrases used for prompt biasing and for snapping near misses
+    phrases = [c.pattern for c in command_registry.commands if not c.has_slots()]
+    phrases += [f"{verb} {key}" for verb in ("press", "hold") for key in key_map]
+    phrases += [f"move mouse {d}" for d in mouse_directions]
+    phrases += [f"{verb} {app}" for verb in ("open", "close") for app in config.get("app_aliases", {})]
+    return phrases
+
+
+class CommandRecognizer:
+    # Fast path for command mode: a small model, greedy decoding with a short
+    # token budget and a prompt listing the command vocabulary, checked
+    # against the command grammar. Returns None when not confident so the
+    # caller can fall back to a full decode.
+    def __init__(self, settings, asr_settings, fp16=False):
+        self.min_confidence = settings.get("min_confidence", 0.6)
+        self.max_samples = int(settings.get("max_audio_s", 4) * sample_rate)
+        self.max_tokens = int(settings.get("max_tokens", 24))
+        engine_settings = dict(asr_settings, model=settings.get("model", "tiny.en"), beam_size=1)
+        self.models = shared_models(engine_settings, fp16=fp16, name="command")
+        self.set_phrases(command_phrases())
+        self.stats = {"fast": 0, "fallback": 0, "last_ms": 0.0}
+
+    def set_phrases(self, phrases):
+        # Whisper keeps at most ~220 prompt tokens, so bias with the distinct
+        # command words rather than every phrase
+        vocabulary = list(dict.fromkeys(w for phrase in phrases for w in phrase.split()))
+        self.prompt = "Commands: " + ", ".join(vocabulary)[:700] + "."
+        self.phrases = phrases
+
+    def start(self):
+        self.models.start()
+
+    def recognize(self, audio):
+        if len(audio) > self.max_samples:
+            return None
+        engine = self.models.get(timeout=0)
+        if engine is None:
+            return None
+        start = time.perf_counter()
+        segments = engine.transcribe(audio, language="en", initial_prompt=self.prompt, temperature=0.0,
+                                     condition_on_previous_text=False, without_timestamps=True,
+                                     max_tokens=self.max_tokens)
+        norm = normalize_command(segments_text(segments))
+        confidence = 0.0
+        if segments:
+            avg_logprob = sum(seg["avg_logprob"] for seg in segments) / len(segments)
+            no_speech = max(seg["no_speech_prob"] for seg in segments)
+            confidence = math.exp(avg_logprob) * (1 - no_speech)
+        if norm and not is_command(norm):
+            match = difflib.get_close_matches(norm, self.phrases, n=1, cutoff=0.8)
+            if match:
+                confidence *= difflib.SequenceMatcher(None, norm, match[0]).ratio()
+                norm = match[0]
+            else:
+                confidence = 0.0
+        self.stats["last_ms"] = (time.perf_counter() - start) * 1000
+        if not norm or confidence < self.min_confidence:
+            self.stats["fallback"] += 1
+            logging.debug(f"Command fast path unsure ({confidence:.2f}): '{norm}'")
+            return None
+        self.stats["fast"] += 1
+        logging.debug(f"Command fast path: '{norm}' ({confidence:.2f}) in {self.stats['last_ms']:.0f}ms")
+        return norm
+
+
+class WakeWordDetector:
+    # Gate in front of the ASR while asleep: each utterance is checked for the
+    # wake phrase by something much cheaper than the full model, and only a
+    # match wakes the pipeline. Anything longer than max_audio_s can't be
+    # just the wake phrase and is dropped without any decode. Backends
+    # implement detect(audio) -> True/False, or None when they can't decide
+    # yet (model still loading); the caller then decodes as before.
+    def __init__(self, settings):
+        self.max_samples = int(settings.get("max_audio_s", 2.5) * sample_rate)
+        self.stats = {"woke": 0, "rejected": 0, "too_long": 0, "last_ms": 0.0}
+
+    def start(self):
+        pass
+
+    def wait(self):
+        pass
+
+    def detect(self, audio):
+        raise NotImplementedError
+
+    def check(self, audio):
+        if len(audio) > self.max_samples:
+            result = "too_long"
+        else:
+            start = time.perf_counter()
+            hit = self.detect(audio)
+            if hit is None:
+                return None
+            self.stats["last_ms"] = (time.perf_counter() - start) * 1000
+            metrics.observe("wake_ms", self.stats["last_ms"])
+            result = "woke" if hit else "rejected"
+        self.stats[result] += 1
+        metrics.inc("wake_checks_total", result=result)
+        return result == "woke"
+
+
+class TemplateWakeWord(WakeWordDetector):
+    # Keyword spotting against the user's own recordings of the wake phrase
+    # (see `enroll`): MFCCs compared by dynamic time warping, a few
+    # milliseconds per utterance. Re-reads templates_dir when it changes.
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.directory = os.path.expanduser(settings.get("templates_dir", "~/.local/share/whisper-dictation/wake"))
+        self.threshold = settings.get("template_threshold", 0.3)
+        self.frame = int(sample_rate * 0.025)
+        self.hop = int(sample_rate * 0.010)
+        self.window = np.hamming(self.frame)
+        self.mel = self.mel_filterbank(26, 512)
+        n = self.mel.shape[0]
+        # DCT-II rows 1..12 (c0 is loudness, dropped)
+        self.dct = np.cos(np.pi / n * (np.arange(n) + 0.5)[None, :] * np.arange(1, 13)[:, None])
+        self.templates = []
+        self.stamp = None
+        self.load_templates()
+        if not self.templates:
+            raise ValueError(f"no wake word templates in {self.directory} (run `enroll`)")
+
+    def mel_filterbank(self, n_mels, n_fft):
+        def to_mel(hz):
+            return 2595 * np.log10(1 + hz / 700)
+
+        points = 700 * (10 ** (np.linspace(to_mel(60), to_mel(sample_rate / 2), n_mels + 2) / 2595) - 1)
+        bins = np.floor((n_fft + 1) * points / sample_rate).astype(int)
+        bank = np.zeros((n_mels, n_fft // 2 + 1))
+        for i in range(n_mels):
+            left, center, right = bins[i], bins[i + 1], bins[i + 2]
+            bank[i, left:center] = (np.arange(left, center) - left) / max(center - left, 1)
+            bank[i, center:right] = (right - np.arange(center, right)) / max(right - center, 1)
+        return bank
+
+    def features(self, audio):
+        # Unit-length, mean-normalized MFCC rows of the voiced part
+        audio = np.asarray(audio, dtype=np.float32)
+        if len(audio) < self.frame:
+            audio = np.pad(audio, (0, self.frame - len(audio)))
+        frames = np.lib.stride_tricks.sliding_window_view(audio, self.frame)[::self.hop]
+        energy = np.log(np.einsum("ij,ij->i", frames, frames) + 1e-10)
+        voiced = np.flatnonzero(energy > energy.max() - 7)  # within ~30 dB of the loudest frame
+        frames = frames[voiced[0]:voiced[-1] + 1]
+        frames = np.concatenate((frames[:, :1], frames[:, 1:] - 0.97 * frames[:, :-1]), axis=1) * self.window
+        log_mel = np.log(np.abs(np.fft.rfft(frames, 512)) ** 2 @ self.mel.T + 1e-10)
+        feats = log_mel @ self.dct.T
+        feats -= feats.mean(axis=0)
+        return feats / np.maximum(np.linalg.norm(feats, axis=1, keepdims=True), 1e-8)
+
+    def distance(self, a, b):
+        # Symmetric DTW with slope constraint (steps (1,1), (1,2), (2,1)),
+        # normalized to the mean cosine distance along the path; every row
+        # depends only on earlier rows, so each is one vector operation.
+        n, m = len(a), len(b)
+        if n < 2 or m < 2 or n > 2 * m or m > 2 * n:
+            return math.inf
+        cost = 1 - a @ b.T
+        total = np.full((n, m), np.inf)
+        total[0, 0] = 2 * cost[0, 0]
+        for i in range(1, n):
+            row = np.full(m, np.inf)
+            row[1:] = total[i - 1, :-1] + 2 * cost[i, 1:]
+            row[2:] = np.minimum(row[2:], total[i - 1, :-2] + 2 * cost[i, 1:-1] + cost[i, 2:])
+            if i >= 2:
+                row[1:] = np.minimum(row[1:], total[i - 2, :-1] + 2 * cost[i - 1, 1:] + cost[i, 1:])
+            total[i] = row
+        return float(total[-1, -1] / (n + m))
+
+    def load_templates(self):
+        try:
+            stamp = os.stat(self.directory).st_mtime_ns
+        except OSError:
+            stamp = None
+        if stamp == self.stamp:
+            return
+        self.stamp = stamp
+        templates = []
+        if stamp is not None:
+            for name in sorted(os.listdir(self.directory)):
+                if name.lower().endswith(".wav"):
+                    try:
+                        templates.append(self.features(load_audio_file(os.path.join(self.directory, name))))
+                    except (OSError, ValueError) as e:
+                        logging.error(f"Skipping wake word template {name}: {e}")
+        self.templates = templates
+        logging.info(f"Loaded {len(templates)} wake word template(s) from {self.directory}")
+
+    def score(self, audio):
+        feats = self.features(audio)
+        return min((self.distance(feats, t) for t in self.templates), default=math.inf)
+
+    def detect(self, audio):
+        self.load_templates()
+        return self.score(audio) <= self.threshold
+
+
+class WhisperWakeWord(WakeWordDetector):
+    # No templates enrolled: short utterances get a greedy decode by the
+    # small command model (shared with the command recognizer when it uses
+    # the same one), prompted with the wake phrases.
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.phrases = [normalize_command(p) for p in settings.get("phrases", ["wake up", "start listening"])]
+        self.prompt = ", ".join(self.phrases) + "."
+        engine_settings = dict(config.get("asr", {}), model=settings.get("model", "tiny.en"), beam_size=1)
+        self.models = shared_models(engine_settings, fp16=config.get("use_fp16", False), name="wake")
+
+    def start(self):
+        self.models.start()
+
+    def wait(self):
+        self.models.get()
+
+    def detect(self, audio):
+        engine = self.models.get(timeout=0)
+        if engine is None:
+            return None
+        segments = engine.transcribe(audio, language="en", initial_prompt=self.prompt, temperature=0.0,
+                                     condition_on_previous_text=False, without_timestamps=True, max_tokens=8)
+        norm = normalize_command(segments_text(segments))
+        return any(p in norm or difflib.SequenceMatcher(None, norm, p).ratio() >= 0.8 for p in self.phrases)
+
+
+class OpenWakeWord(WakeWordDetector):
+    # Pretrained ONNX keyword models from openWakeWord (pip install
+    # openwakeword), e.g. "hey_jarvis"; the utterance is scored in the 80 ms
+    # frames the models expect.
+    def __init__(self, settings):
+        super().__init__(settings)
+        from openwakeword.model import Model
+        names = settings.get("openwakeword_models", [])
+        self.model = Model(wakeword_models=names) if names else Model()
+        self.threshold = settings.get("openwakeword_threshold", 0.5)
+
+    def detect(self, audio):
+        self.model.reset()
+        pcm = (np.clip(audio, -1, 1) * 32767).astype(np.int16)
+        best = 0.0
+        for pos in range(0, len(pcm) - 1279, 1280):
+            scores = self.model.predict(pcm[pos:pos + 1280])
+            best = max(best, max(scores.values(), default=0.0))
+        return best >= self.threshold
+
+
+wake_word_backends = {"templates": TemplateWakeWord, "whisper": WhisperWakeWord, "openwakeword": OpenWakeWord}
+
+
+def make_wake_word(settings):
+    if not settings.get("enabled", True):
+        return None
+    backend = settings.get("backend", "auto")
+    if backend == "auto":
+        directory = os.path.expanduser(settings.get("templates_dir", "~/.local/share/whisper-dictation/wake"))
+        enrolled = os.path.isdir(directory) and any(n.lower().endswith(".wav") for n in os.listdir(directory))
+        backend = "templates" if enrolled else "whisper"
+    try:
+        return wake_word_backends[backend](settings)
+    except Exception as e:
+        logging.error(f"Wake word backend '{backend}' unavailable, using whisper: {e}")
+        return WhisperWakeWord(settings)
+
+
+class RingBuffer:
+    # Preallocated float32 sample ring. Written from the PortAudio callback and
+    # drained by the segmenter thread; positions are absolute sample counts so
+    # an overrun (reader lapped by the writer) only drops the oldest audio.
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self.data = np.zeros(self.capacity, dtype=np.float32)
+        self.write_pos = 0
+        self.read_pos = 0
+        self.overruns = 0
+        self.cond = threading.Condition()
+
+    def write(self, samples):
+        n = len(samples)
+        with self.cond:
+            if n > self.capacity:
+                self.write_pos += n - self.capacity
+                samples = samples[-self.capacity:]
+                n = self.capacity
+            start = self.write_pos % self.capacity
+            first = min(n, self.capacity - start)
+            self.data[start:start + first] = samples[:first]
+            if first < n:
+                self.data[:n - first] = samples[first:]
+            self.write_pos += n
+            if self.write_pos - self.read_pos > self.capacity:
+                self.read_pos = self.write_pos - self.capacity
+                self.overruns += 1
+            self.cond.notify()
+
+    def read(self, max_samples, timeout=None):
+        # Returns up to max_samples unread samples (possibly empty on timeout).
+        with self.cond:
+            if self.write_pos == self.read_pos:
+                self.cond.wait(timeout)
+            n = min(int(max_samples), self.write_pos - self.read_pos)
+            start = self.read_pos % self.capacity
+            first = min(n, self.capacity - start)
+            out = np.empty(n, dtype=np.float32)
+            out[:first] = self.data[start:start + first]
+            out[first:] = self.data[:n - first]
+            self.read_pos += n
+            return out
+
+    def fill(self):
+        with self.cond:
+            return self.write_pos - self.read_pos
+
+
+class Utterance:
+    # One VAD-delimited stretch of speech
+    def __init__(self, uid, audio, start_sample):
+        self.id = uid
+        self.audio = audio
+        self.start_sample = start_sample
+        self.closed_at = time.time()
+        self.trace = UtteranceTrace(self)
+
+    def duration(self):
+        return len(self.audio) / sample_rate
+
+
+class UtteranceTrace:
+    # Wall-clock marks for one utterance's trip through the pipeline:
+    # capture_end -> vad_close -> inference_start -> inference_end ->
+    # dispatch -> injection_done
+    spans = (
+        ("vad_ms", "capture_end", "vad_close"),
+        ("queue_ms", "vad_close", "inference_start"),
+        ("inference_ms", "inference_start", "inference_end"),
+        ("dispatch_ms", "inference_end", "dispatch"),
+        ("injection_ms", "dispatch", "injection_done"),
+        ("end_to_end_ms", "capture_end", "injection_done"),
+    )
+
+    def __init__(self, utterance):
+        self.marks = {"vad_close": utterance.closed_at}
+        self.info = {"id": utterance.id, "audio_s": round(utterance.duration(), 3)}
+
+    def mark(self, stage, when=None):
+        self.marks[stage] = when if when is not None else time.time()
+
+    def durations(self):
+        return {
+            name: (self.marks[b] - self.marks[a]) * 1000
+            for name, a, b in self.spans
+            if a in self.marks and b in self.marks
+        }
+
+
+class VAD:
+    # Frame-level speech decisions smoothed by onset/hangover counters.
+    # Backends implement is_speech(frame); process() turns the block stream
+    # into variable-length utterances so silence never reaches Whisper.
+    def __init__(self, sample_rate, settings):
+        self.sample_rate = sample_rate
+        frame_ms = settings.get("frame_ms", 30)
+        self.frame_len = int(sample_rate * frame_ms / 1000)
+        self.onset_frames = max(1, round(settings.get("onset_ms", 90) / frame_ms))
+        self.hangover_frames = max(1, round(settings.get("hangover_ms", 600) / frame_ms))
+        self.tail_frames = min(self.hangover_frames, max(1, round(200 / frame_ms)))
+        pre_roll_frames = round(settings.get("pre_roll_ms", 300) / frame_ms)
+        self.min_voiced_frames = max(1, round(settings.get("min_utterance_ms", 250) / frame_ms))
+        self.max_frames = max(1, round(settings.get("max_utterance_s", 20) * 1000 / frame_ms))
+        self.onset_buffer = collections.deque(maxlen=pre_roll_frames + self.onset_frames)
+        self.pending = np.empty(0, dtype=np.float32)
+        self.position = 0
+        self.utterance_id = 0
+        self.reset()
+
+    def reset(self):
+        self.onset_buffer.clear()
+        self.frames = []
+        self.in_speech = False
+        self.speech_run = 0
+        self.silence_run = 0
+        self.voiced_frames = 0
+        self.start_sample = 0
+
+    def is_speech(self, frame):
+        raise NotImplementedError
+
+    def process(self, block):
+        utterances = []
+        if len(self.pending):
+            block = np.concatenate((self.pending, block))
+        n = len(block) // self.frame_len
+        self.pending = block[n * self.frame_len:].copy()
+        for frame in block[:n * self.frame_len].reshape(n, self.frame_len):
+            self.position += self.frame_len
+            voiced = self.is_speech(frame)
+            if not self.in_speech:
+                self.onset_buffer.append(frame)
+                self.speech_run = self.speech_run + 1 if voiced else 0
+                if self.speech_run >= self.onset_frames:
+                    self._open(list(self.onset_buffer))
+                    self.onset_buffer.clear()
+                    self.voiced_frames = self.speech_run
+                continue
+            self.frames.append(frame)
+            if voiced:
+                self.silence_run = 0
+                self.voiced_frames += 1
+            else:
+                self.silence_run += 1
+            if self.silence_run >= self.hangover_frames:
+                utterance = self._close()
+                if utterance is not None:
+                    utterances.append(utterance)
+            elif len(self.frames) >= self.max_frames:
+                # Over-long speech: cut here but stay in the speech state
+                utterance = self._close()
+                if utterance is not None:
+                    utterances.append(utterance)
+                self._open([])
+        return utterances
+
+    def current(self):
+        # Snapshot of the utterance still being spoken, for streaming decodes
+        if not self.in_speech or not self.frames:
+            return None, None
+        return np.concatenate(self.frames), self.utterance_id
+
+    def flush(self):
+        if self.in_speech:
+            return self._close()
+        return None
+
+    def _open(self, frames):
+        self.utterance_id += 1
+        self.in_speech = True
+        self.frames = frames
+        self.silence_run = 0
+        self.start_sample = self.position - len(frames) * self.frame_len
+
+    def _close(self):
+        frames = self.frames
+        if self.silence_run > self.tail_frames:
+            frames = frames[:len(frames) - self.silence_run + self.tail_frames]
+        voiced = self.voiced_frames
+        self.frames = []
+        self.in_speech = False
+        self.speech_run = 0
+        self.silence_run = 0
+        self.voiced_frames = 0
+        if voiced < self.min_voiced_frames or not frames:
+            return None
+        return Utterance(self.utterance_id, np.concatenate(frames), self.start_sample)
+
+
+class EnergyVAD(VAD):
+    # RMS energy against an adaptive noise floor, with a zero-crossing cap to
+    # reject broadband hiss and clicks.
+    def __init__(self, sample_rate, settings):
+        super().__init__(sample_rate, settings)
+        self.energy_ratio = settings.get("energy_ratio", 3.0)
+        self.min_rms = settings.get("min_rms", 0.004)
+        self.zcr_max = settings.get("zcr_max", 0.45)
+        self.noise_floor = self.min_rms / self.energy_ratio
+
+    def is_speech(self, frame):
+        rms = float(np.sqrt(np.dot(frame, frame) / len(frame)))
+        zcr = np.count_nonzero(np.signbit(frame[1:]) != np.signbit(frame[:-1])) / len(frame)
+        voiced = rms > max(self.min_rms, self.noise_floor * self.energy_ratio) and zcr <= self.zcr_max
+        if not voiced:
+            # Track the floor quickly downwards and slowly upwards
+            rate = 0.5 if rms < self.noise_floor else 0.02
+            self.noise_floor += rate * (rms - self.noise_floor)
+        return voiced
+
+
+class WebRtcVAD(VAD):
+    def __init__(self, sample_rate, settings):
+        import webrtcvad
+        super().__init__(sample_rate, settings)
+        if settings.get("frame_ms", 30) not in (10, 20, 30):
+            raise ValueError("webrtc VAD needs frame_ms of 10, 20 or 30")
+        self.vad = webrtcvad.Vad(int(settings.get("webrtc_aggressiveness", 2)))
+
+    def is_speech(self, frame):
+        pcm = (np.clip(frame, -1.0, 1.0) * 32767).astype(np.int16).tobytes()
+        return self.vad.is_speech(pcm, self.sample_rate)
+
+
+vad_backends = {"energy": EnergyVAD, "webrtc": WebRtcVAD}
+
+
+def make_vad(settings):
+    backend = settings.get("backend", "energy")
+    try:
+        return vad_backends[backend](sample_rate, settings)
+    except Exception as e:
+        logging.error(f"VAD backend '{backend}' unavailable, using energy VAD: {e}")
+        return EnergyVAD(sample_rate, settings)
+
+
+class NoiseSuppressor:
+    # Streaming cleanup ahead of the VAD: a high-pass filter, spectral gating
+    # against a per-bin noise profile that is tracked continuously, then AGC.
+    # Each block is processed as a whole with NumPy (a 100 ms block is ~6 STFT
+    # frames); output has the same length as input and lags it by two hops.
+    def __init__(self, sample_rate, settings):
+        from scipy.signal import butter, sosfilt
+        self.sosfilt = sosfilt
+        self.n_fft = 1 << int(round(math.log2(settings.get("frame_ms", 32) * sample_rate / 1000)))
+        self.hop = self.n_fft // 2
+        # Periodic sqrt-Hann for analysis and synthesis: the two products sum
+        # to one at 50% overlap, so an open gate reproduces the input exactly
+        self.window = np.sqrt(np.hanning(self.n_fft + 1)[:-1]).astype(np.float32)
+        cutoff = settings.get("highpass_hz", 80)
+        self.sos = butter(2, cutoff, btype="highpass", fs=sample_rate, output="sos") if cutoff else None
+        self.zi = np.zeros((len(self.sos), 2)) if self.sos is not None else None
+        self.threshold = float(settings.get("threshold", 2.0))
+        self.floor = 10 ** (-float(settings.get("reduction_db", 18)) / 20)
+        frames_per_s = sample_rate / self.hop
+        # The noise profile is the mean magnitude of each bin: it follows bins
+        # below the gate within ~50 ms but drifts only over seconds while the
+        # gate is open, so speech isn't learnt as noise
+        self.adapt = 0.3
+        self.drift = 1 / (float(settings.get("noise_rise_s", 3)) * frames_per_s)
+        self.release = 0.7
+        self.noise = None
+        self.gain = np.ones(self.n_fft // 2 + 1, dtype=np.float32)
+        self.agc = settings.get("agc", True)
+        self.target = 10 ** (float(settings.get("agc_target_dbfs", -20)) / 20)
+        self.max_gain = 10 ** (float(settings.get("agc_max_gain_db", 20)) / 20)
+        self.agc_gain = 1.0
+        self.delay = 2 * self.hop
+        self.pending = np.zeros(self.n_fft - self.hop, dtype=np.float32)
+        self.overlap = np.zeros(self.hop, dtype=np.float32)
+        self.output = np.zeros(self.hop, dtype=np.float32)
+
+    def process(self, block):
+        block = np.asarray(block, dtype=np.float32)
+        if self.sos is not None:
+            block, self.zi = self.sosfilt(self.sos, block, zi=self.zi)
+            block = block.astype(np.float32)
+        self.pending = np.concatenate([self.pending, block])
+        count = (len(self.pending) - self.n_fft) // self.hop + 1
+        if count > 0:
+            frames = np.lib.stride_tricks.sliding_window_view(self.pending, self.n_fft)[::self.hop][:count]
+            self.pending = self.pending[count * self.hop:]
+            self.output = np.concatenate([self.output, self._gate(frames)])
+        out, self.output = self.output[:len(block)], self.output[len(block):]
+        return out
+
+    def _gate(self, frames):
+        spec = np.fft.rfft(frames * self.window, axis=1)
+        mag = np.abs(spec)
+        gains = np.empty_like(mag)
+        if self.noise is None:
+            self.noise = mag[0].copy()
+        # Noise tracking and gain smoothing are recursive, so only this loop
+        # runs per frame; every step in it is vectorized over the bins
+        for i, m in enumerate(mag):
+            self.noise += np.where(m < self.noise * self.threshold, self.adapt, self.drift) * (m - self.noise)
+            opening = np.clip(m / (self.noise * self.threshold + 1e-10) - 1, 0, 1)
+            self.gain = np.maximum(self.floor + (1 - self.floor) * opening, self.gain * self.release)
+            gains[i] = self.gain
+        gains[:, 1:-1] = 0.25 * gains[:, :-2] + 0.5 * gains[:, 1:-1] + 0.25 * gains[:, 2:]
+        cleaned = spec * gains
+        out_frames = np.fft.irfft(cleaned, n=self.n_fft, axis=1).astype(np.float32) * self.window
+        tails = np.concatenate([self.overlap[None], out_frames[:-1, self.hop:]])
+        self.overlap = out_frames[-1, self.hop:].copy()
+        out = (out_frames[:, :self.hop] + tails).reshape(-1)
+        if self.agc:
+            # Only adapt on frames the gate mostly let through (speech), so
+            # silence is never pumped up
+            passed = np.sum(np.abs(cleaned) ** 2) / max(np.sum(mag ** 2), 1e-12)
+            previous = self.agc_gain
+            rms = float(np.sqrt(np.mean(out ** 2)))
+            if passed > 0.5 and rms > 1e-4:
+                desired = min(self.max_gain, max(1 / self.max_gain, self.target / rms))
+                self.agc_gain += (desired - self.agc_gain) * (0.5 if desired < self.agc_gain else 0.1)
+            out *= np.linspace(previous, self.agc_gain, len(out), dtype=np.float32)
+            np.clip(out, -1.0, 1.0, out=out)
+        return out
+
+    def process_all(self, audio, block=1600):
+        # Offline use (batch): same processing with the delay removed
+        padded = np.concatenate([np.asarray(audio, dtype=np.float32), np.zeros(self.delay, dtype=np.float32)])
+        out = np.concatenate([self.process(padded[i:i + block]) for i in range(0, len(padded), block)])
+        return out[self.delay:]
+
+
+def make_suppressor(settings):
+    if not settings.get("enabled", False):
+        return None
+    return NoiseSuppressor(sample_rate, settings)
+
+
+class AudioCapture:
+    # Continuous microphone capture: an InputStream callback feeds the ring
+    # buffer, a segmenter thread runs the VAD over it and queues utterances.
+    # stream_factory takes the InputStream keyword arguments (bench replays
+    # files through one); time_scale is stream seconds per wall second;
+    # preprocessor (noise suppression) cleans each block before the VAD.
+    def __init__(self, sample_rate, block_size, ring_seconds, vad, stream_factory=None, time_scale=1.0,
+                 preprocessor=None):
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+        self.ring = RingBuffer(sample_rate * ring_seconds)
+        self.vad = vad
+        self.chunks = queue.Queue()
+        self.max_queue_depth = 0
+        self.status_errors = 0
+        self.stream = None
+        self.running = False
+        self.segment_lock = threading.Lock()
+        self.level = None
+        self.started_at = None
+        self.stream_factory = stream_factory
+        self.preprocessor = preprocessor
+        self.time_scale = time_scale
+        self.segment_thread = None
+
+    def _callback(self, indata, frames, time_info, status):
+        if status:
+            self.status_errors += 1
+        self.ring.write(indata[:, 0])
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        factory = self.stream_factory
+        if factory is None:
+            if sd is None:
+                raise RuntimeError("sounddevice (PortAudio) is not available")
+            factory = sd.InputStream
+        self.started_at = time.time()
+        self.stream = factory(samplerate=self.sample_rate, channels=1, dtype="float32",
+                              blocksize=self.block_size, callback=self._callback)
+        self.stream.start()
+        self.segment_thread = threading.Thread(target=self._segment_loop, daemon=True)
+        self.segment_thread.start()
+        logging.info(f"Audio capture started ({self.block_size} samples/block, {self.ring.capacity} sample ring).")
+
+    def stop(self):
+        self.running = False
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+        if self.segment_thread is not None:
+            # Drains the ring and flushes the VAD before returning
+            self.segment_thread.join(timeout=5)
+            self.segment_thread = None
+
+    def _segment_loop(self):
+        while self.running or self.ring.fill():
+            block = self.ring.read(self.block_size, timeout=0.5)
+            if not len(block):
+                continue
+            preprocessor = self.preprocessor
+            if preprocessor is not None:
+                block = preprocessor.process(block)
+            if bus.has_subscribers("level"):
+                self.publish_level(block)
+            with self.segment_lock:
+                for utterance in self.vad.process(block):
+                    self.put_chunk(utterance)
+        with self.segment_lock:
+            utterance = self.vad.flush()
+            if utterance is not None:
+                self.put_chunk(utterance)
+
+    def current_speech(self):
+        # The open utterance, or (None, None). Taken under the segment lock so
+        # every utterance that closed before it is already in the queue.
+        with self.segment_lock:
+            if not self.chunks.empty():
+                return None, None
+            return self.vad.current()
+
+    def publish_level(self, block):
+        # Whole-dB steps, so the meter only repaints when the level moves
+        rms = float(np.sqrt(np.dot(block, block) / len(block)))
+        level = max(-60, int(20 * math.log10(max(rms, 1e-6))))
+        if level != self.level:
+            self.level = level
+            bus.publish("level", level)
+
+    def put_chunk(self, chunk):
+        if self.started_at is not None:
+            # Stream time of the utterance's last sample (ignores ring overruns)
+            end_sample = chunk.start_sample + len(chunk.audio)
+            stream_time = end_sample / (self.sample_rate * self.time_scale)
+            chunk.trace.mark("capture_end", min(chunk.closed_at, self.started_at + stream_time))
+        self.chunks.put(chunk)
+        self.max_queue_depth = max(self.max_queue_depth, self.chunks.qsize())
+        self.publish_queue()
+
+    def publish_queue(self):
+        metrics.gauge("queue_depth", self.queue_depth())
+        if bus.has_subscribers("queue"):
+            bus.publish("queue", self.stats())
+
+    def queue_depth(self):
+        return self.chunks.qsize()
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth(),
+            "max_queue_depth": self.max_queue_depth,
+            "ring_fill": self.ring.fill(),
+            "overruns": self.ring.overruns,
+            "status_errors": self.status_errors,
+            "in_speech": self.vad.in_speech,
+        }
+
+
+capture = AudioCapture(sample_rate, block_size, ring_seconds, make_vad(config.get("vad", {})),
+                       preprocessor=make_suppressor(config.get("noise_suppression", {})))
+
+
+def load_audio_file(path):
+    # Read a WAV file as float32 mono at sample_rate
+    rate, data = scipy.io.wavfile.read(path)
+    if data.dtype.kind == "i":
+        data = data.astype(np.float32) / np.iinfo(data.dtype).max
+    elif data.dtype.kind == "u":
+        data = (data.astype(np.float32) - 128) / 128
+    data = data.astype(np.float32)
+    if data.ndim > 1:
+        data = data.mean(axis=1)
+    if rate != sample_rate:
+        from scipy.signal import resample_poly
+        g = np.gcd(int(rate), sample_rate)
+        data = resample_poly(data, sample_rate // g, int(rate) // g).astype(np.float32)
+    return np.ascontiguousarray(data)
+
+
+def dump_audio(audio):
+    # Debug aid: keep a copy of what was sent to the model
+    dump_dir = os.path.expanduser(config.get("debug", {}).get("dump_dir", "~/.local/share/whisper-dictation/audio"))
+    os.makedirs(dump_dir, exist_ok=True)
+    filename = os.path.join(dump_dir, time.strftime("%Y%m%d-%H%M%S") + f"-{int(time.time() * 1000) % 1000:03d}.wav")
+    try:
+        scipy.io.wavfile.write(filename, sample_rate, audio)
+        logging.debug(f"Dumped utterance audio to {filename}")
+    except OSError as e:
+        logging.error(f"Could not dump audio to {filename}: {e}")
+
+
+control_phrases = ("wake up", "start listening", "stop listening", "command mode", "dictation mode")
+undo_phrases = ("scratch that", "undo last")
+
+
+def set_mode(new_mode):
+    global mode
+    mode = new_mode
+    bus.set_state(mode=mode)
+
+
+def set_listening(awake):
+    global listening
+    listening = awake
+    bus.set_state(listening=listening)
+
+
+def apply_control(norm):
+    # Listening/mode switches work in every mode; returns True if one matched
+    if "wake up" in norm or "start listening" in norm:
+        set_listening(True)
+    elif "stop listening" in norm:
+        set_listening(False)
+    elif "command mode" in norm:
+        set_mode("command")
+    elif "dictation mode" in norm:
+        set_mode("dictation")
+    elif listening and norm in undo_phrases:
+        # Whole utterance only, so "scratch that" inside a sentence is typed
+        undo_last()
+    else:
+        return False
+    return True
+
+
+def control_holdback(words):
+    # How many trailing words could still grow into a control phrase; those
+    # are not typed until the utterance shows they are ordinary dictation.
+    keys = [normalize_command(w) for w in words]
+    for n in range(min(len(keys), 2), 0, -1):
+        tail = " ".join(keys[-n:])
+        if any(phrase == tail or phrase.startswith(tail + " ") for phrase in control_phrases + undo_phrases):
+            return n
+    return 0
+
+
+class LocalAgreement:
+    # LocalAgreement-2 policy: a word is confirmed once two consecutive
+    # hypotheses over the growing audio buffer agree on it.
+    def __init__(self):
+        self.committed = []
+        self.previous = []
+
+    def insert(self, words):
+        new = words[len(self.committed):]
+        confirmed = []
+        for old, cur in zip(self.previous, new):
+            if normalize_command(old) != normalize_command(cur):
+                break
+            confirmed.append(cur)
+        self.committed.extend(confirmed)
+        self.previous = new[len(confirmed):]
+        return confirmed
+
+
+def focused_app():
+    # Executable name of the process owning the focused window, or None
+    # (Wayland has no portable way to ask)
+    try:
+        if sys.platform.startswith("win"):
+            import ctypes
+            import ctypes.wintypes
+            pid = ctypes.wintypes.DWORD()
+            ctypes.windll.user32.GetWindowThreadProcessId(ctypes.windll.user32.GetForegroundWindow(), ctypes.byref(pid))
+            return normalize_process_name(psutil.Process(pid.value).name())
+        if os.environ.get("DISPLAY") and shutil.which("xdotool"):
+            out = subprocess.run(["xdotool", "getactivewindow", "getwindowpid"], capture_output=True, check=True,
+                                 timeout=1).stdout
+            return normalize_process_name(psutil.Process(int(out)).name())
+    except (OSError, ValueError, subprocess.SubprocessError, psutil.Error):
+        pass
+    return None
+
+
+class PromptContext:
+    # Decoder biasing from the user's vocabulary, a profile for the focused
+    # application and that application's recent dictation, passed as
+    # initial_prompt (and hotwords where the engine has them). Each piece is
+    # tokenized once and cached, so a prompt per utterance is only list
+    # concatenation; engines that take text prompts get the text instead.
+    def __init__(self, settings):
+        self.enabled = settings.get("enabled", True)
+        self.vocabulary = list(settings.get("vocabulary", []))
+        self.profiles = settings.get("profiles", {})
+        self.history_words = int(settings.get("history_words", 40))
+        self.max_tokens = int(settings.get("max_tokens", 200))
+        self.history = collections.defaultdict(collections.deque)
+        self.tokens = {}
+        self.app = None
+        self.app_checked = None
+        self.lock = threading.Lock()
+
+    def current_app(self, always=False):
+        # Only looked up when a profile could match (or the caller always
+        # wants it), at most once a second
+        if not self.profiles and not always:
+            return None
+        if self.app_checked is None or time.monotonic() - self.app_checked > 1.0:
+            self.app = focused_app()
+            self.app_checked = time.monotonic()
+        return self.app
+
+    def profile(self):
+        app = self.current_app()
+        if app:
+            for name, profile in self.profiles.items():
+                if app in {normalize_process_name(a) for a in profile.get("apps", [])}:
+                    return name, profile
+        return "default", {}
+
+    def remember(self, text):
+        text = text.strip()
+        if not self.enabled or not text:
+            return
+        name, _ = self.profile()
+        with self.lock:
+            history = self.history[name]
+            history.append(text)
+            while len(history) > 1 and sum(len(t.split()) for t in history) > self.history_words:
+                history.popleft()
+
+    def _encode(self, engine, text):
+        key = (engine.describe(), text)
+        if key not in self.tokens:
+            if len(self.tokens) > 512:
+                self.tokens.clear()
+            self.tokens[key] = engine.encode_prompt(" " + text)
+        return self.tokens[key]
+
+    def options(self, engine, tail=None):
+        # Keyword arguments for engine.transcribe. tail is text already heard
+        # in the current utterance (streaming); it goes last, nearest the audio.
+        if not self.enabled:
+            return {"initial_prompt": tail} if tail else {}
+        name, profile = self.profile()
+        vocabulary = list(dict.fromkeys(profile.get("vocabulary", []) + self.vocabulary))
+        fixed = [profile.get("prompt", "")] + (["Glossary: " + ", ".join(vocabulary) + "."] if vocabulary else [])
+        fixed = [piece for piece in fixed if piece]
+        with self.lock:
+            recent = list(self.history[name])
+        options = {}
+        if vocabulary and engine.supports_hotwords:
+            options["hotwords"] = " ".join(vocabulary)
+        if not fixed and not recent and not tail:
+            return options
+        if self._encode(engine, "") is None:
+            # Text prompt, budgeted at ~4 characters per token; the oldest
+            # history is dropped first
+            budget = self.max_tokens * 4
+            prompt = " ".join(fixed)[:budget]
+            history = " ".join(recent + ([tail] if tail else []))
+            room = budget - len(prompt) - 1
+            if history and room > 0:
+                if len(history) > room:
+                    history = history[-room:].partition(" ")[2]
+                prompt = f"{prompt} {history}".strip()
+            options["initial_prompt"] = prompt
+            return options
+        prompt = [t for piece in fixed for t in self._encode(engine, piece)][:self.max_tokens]
+        history = [t for piece in recent for t in self._encode(engine, piece)]
+        if tail:
+            history += engine.encode_prompt(" " + tail)
+        budget = self.max_tokens - len(prompt)
+        options["initial_prompt"] = prompt + (history[-budget:] if budget > 0 else [])
+        return options
+
+
+class StreamingDictation:
+    # Re-decodes the open utterance every step and types only confirmed words,
+    # so output trails speech by roughly one step plus one decode.
+    def __init__(self, settings):
+        self.step = settings.get("step_ms", 400) / 1000
+        self.window = int(settings.get("window_s", 12) * sample_rate)
+        self.min_samples = int(settings.get("min_audio_ms", 600) * sample_rate / 1000)
+        self.reset(None)
+
+    def reset(self, utterance_id):
+        self.utterance_id = utterance_id
+        self.agreement = LocalAgreement()
+        self.offset = 0
+        self.decoded_len = 0
+        self.words = []
+        self.typed = 0
+        self.start_chars = typed_chars
+        self.segments = []
+
+    def tail(self):
+        return " ".join(self.words[self.typed:] + self.agreement.previous)
+
+    def _decode(self, engine, audio):
+        # Only words whose audio _trim has cut from the window go into the
+        # prompt; prompted with words it is about to hear, Whisper tends to
+        # skip them and the hypothesis falls out of step with the agreement
+        trimmed = self.words[:len(self.words) - len(self.agreement.committed)]
+        options = prompt_context.options(engine, tail=" ".join(trimmed[-40:]) or None)
+        self.segments = engine.transcribe(audio[self.offset:], language="en", condition_on_previous_text=False,
+                                          **options)
+        return segments_text(self.segments).split()
+
+    def update(self, engine, audio, utterance_id):
+        if utterance_id != self.utterance_id:
+            self.reset(utterance_id)
+        if len(audio) < self.min_samples or len(audio) - self.decoded_len < self.step * sample_rate:
+            return
+        self.decoded_len = len(audio)
+        confirmed = self.agreement.insert(self._decode(engine, audio))
+        self.words.extend(confirmed)
+        self._trim(len(audio) - self.offset)
+        self.type_confirmed(final=False)
+
+    def finish(self, engine, audio):
+        # The utterance has closed: its last hypothesis is final
+        words = self._decode(engine, audio)
+        self.words.extend(words[len(self.agreement.committed):])
+        self.agreement = LocalAgreement()
+        return " ".join(self.words)
+
+    def _trim(self, buffered):
+        # Keep the decode window bounded by cutting audio at the end of the
+        # last segment whose words are all confirmed.
+        if buffered <= self.window:
+            return
+        committed = len(self.agreement.committed)
+        count, cut = 0, None
+        for seg in self.segments:
+            n = len(seg["text"].split())
+            if count + n > committed:
+                break
+            count += n
+            cut = seg["end"]
+        if cut:
+            self.offset += int(cut * sample_rate)
+            del self.agreement.committed[:count]
+
+    def type_confirmed(self, final):
+        end = len(self.words) if final else len(self.words) - control_holdback(self.words[self.typed:])
+        if end <= self.typed:
+            return
+        text = " ".join(self.words[self.typed:end])
+        type_text(" " + text if self.typed else text)
+        self.typed = end
+
+
+def process_utterance(engine, utterance):
+    global last_transcript
+    trace = utterance.trace
+    trace.mark("inference_start")
+    # Whisper takes float32 mono 16 kHz arrays directly, no WAV/ffmpeg round-trip
+    audio = np.ascontiguousarray(utterance.audio, dtype=np.float32).reshape(-1)
+    if config.get("debug", {}).get("dump_audio", False):
+        dump_audio(audio)
+    if not listening and wake_word is not None:
+        woke = wake_word.check(audio)
+        if woke is not None:
+            # Asleep utterances never reach the ASR or the latency metrics.
+            # Without a transcript, the only control honoured while asleep is
+            # the wake phrase; mode switches wait until it is awake.
+            if woke:
+                logging.info(f"Wake word detected in {wake_word.stats['last_ms']:.1f}ms")
+                print("[INFO] Wake word detected, listening")
+                set_listening(True)
+            return
+    logging.debug(f"Transcribing {len(audio) / sample_rate:.2f}s of audio")
+    awake = listening
+    streamed = streamer.utterance_id == utterance.id
+    chars_before = streamer.start_chars if streamed else typed_chars
+    fast = None
+    if mode == "command" and command_recognizer is not None:
+        fast = command_recognizer.recognize(audio)
+    if fast is not None:
+        text, result = fast, []
+        trace.info["path"] = "command"
+    elif streamed:
+        text = streamer.finish(engine, audio)
+        result = streamer.segments
+        trace.info["path"] = "streaming"
+    else:
+        result = engine.transcribe(audio, language='en', **prompt_context.options(engine))
+        text = segments_text(result)
+        trace.info["path"] = "full"
+    trace.mark("inference_end")
+    inference_s = trace.marks["inference_end"] - trace.marks["inference_start"]
+    logging.info(f"Transcribed {utterance.duration():.2f}s of audio in {inference_s:.2f}s: {text!r}")
+    logging.debug(f"Transcription segments: {result}")
+    norm = normalize_command(text)
+    print(f"Transcript: {text}")
+    last_transcript = text[:200]
+    bus.set_state(last_transcript=last_transcript)
+    set_partial("")
+    trace.mark("dispatch")
+    if apply_control(norm):
+        trace.info["action"] = "control"
+    elif listening:
+        trace.info["action"] = mode
+        if mode == "dictation":
+            if streamed:
+                streamer.type_confirmed(final=True)
+            else:
+                type_text(text)
+            prompt_context.remember(text)
+        elif mode == "command":
+            handle_command(norm)
+    if streamed:
+        streamer.reset(None)
+    trace.mark("injection_done")
+    trace.info["tokens"] = sum(len(seg["tokens"]) for seg in result)
+    record_trace(trace, inference_s, utterance.duration())
+    # What is overheard while asleep stays out of the journal; only the
+    # control phrase that woke it up is kept
+    if awake or trace.info.get("action") == "control":
+        journal_utterance(trace, text, typed_chars - chars_before)
+
+
+class Journal:
+    # Append-only JSONL record of every utterance (text, time, mode, action,
+    # characters typed, latency) and of every undo. Rotated to .1 .. .keep at
+    # max_bytes; only the last `memory` entries are held in memory, for undo.
+    # Disabled, nothing is written but undo still works.
+    def __init__(self, settings):
+        self.path = None
+        if settings.get("enabled", True) and settings.get("path"):
+            self.path = os.path.expanduser(settings["path"])
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.max_bytes = int(settings.get("max_bytes", 5000000))
+        self.keep = max(1, int(settings.get("keep", 3)))
+        self.recent = collections.deque(maxlen=int(settings.get("memory", 50)))
+        self.lock = threading.Lock()
+
+    def files(self):
+        # Oldest first
+        if self.path is None:
+            return []
+        rotated = [f"{self.path}.{i}" for i in range(self.keep, 0, -1)]
+        return [p for p in rotated + [self.path] if os.path.exists(p)]
+
+    def write(self, record):
+        if self.path is None:
+            return
+        with self.lock:
+            try:
+                if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                    for i in range(self.keep - 1, 0, -1):
+                        if os.path.exists(f"{self.path}.{i}"):
+                            os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+                    os.replace(self.path, self.path + ".1")
+                # Dictated text is private: the file is only readable by the user
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+                with os.fdopen(fd, "a") as f:
+                    f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            except OSError as e:
+                logging.error(f"Could not write journal {self.path}: {e}")
+
+    def record(self, entry):
+        with self.lock:
+            self.recent.append(entry)
+        self.write(entry)
+
+    def last_undoable(self):
+        with self.lock:
+            for entry in reversed(self.recent):
+                if entry.get("chars") and not entry.get("undone"):
+                    return entry
+        return None
+
+    def mark_undone(self, entry):
+        entry["undone"] = True
+        self.write({"type": "undo", "ts": round(time.time(), 3), "target": entry["ts"], "chars": entry["chars"]})
+
+    def query(self, search=None, mode=None, since=None, limit=50):
+        # Newest `limit` utterances matching all given filters, oldest first,
+        # read a line at a time from the files (or from memory when disabled)
+        def matches(entry):
+            return (entry.get("type") == "utterance"
+                    and (search is None or search.lower() in entry.get("text", "").lower())
+                    and (mode is None or entry.get("mode") == mode)
+                    and (since is None or entry.get("ts", 0) >= since))
+
+        if self.path is None:
+            with self.lock:
+                return [dict(e) for e in self.recent if matches(e)][-limit:]
+        found = collections.deque(maxlen=limit)
+        undone = set()
+        for path in self.files():
+            try:
+                with open(path) as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue
+                        if entry.get("type") == "undo":
+                            undone.add(entry.get("target"))
+                        elif matches(entry):
+                            found.append(entry)
+            except OSError as e:
+                logging.error(f"Could not read journal {path}: {e}")
+        return [dict(e, undone=True) if e.get("ts") in undone else e for e in found]
+
+
+journal = Journal(config.get("journal", {}))
+
+
+def journal_utterance(trace, text, chars):
+    durations = trace.durations()
+    entry = {"type": "utterance", "ts": round(trace.marks["vad_close"], 3), "mode": mode,
+             "action": trace.info.get("action", "none"), "path": trace.info.get("path"), "text": text, "chars": chars,
+             "audio_s": trace.info.get("audio_s"), "latency_ms": round(durations.get("end_to_end_ms", 0), 1),
+             "inference_ms": round(durations.get("inference_ms", 0), 1)}
+    if chars:
+        # Where the text went, so undo can refuse once the focus has moved;
+        # usually cached already by the prompt's profile lookup
+        entry["app"] = prompt_context.current_app(always=True)
+    journal.record(entry)
+
+
+def undo_last():
+    # Backspace over the most recent typed utterance not yet undone;
+    # repeating walks further back
+    entry = journal.last_undoable()
+    if entry is None:
+        print("[INFO] Nothing to undo")
+        return False
+    app = focused_app() if entry.get("app") else None
+    if app is not None and app != entry["app"]:
+        print(f"[INFO] Not undoing: the text went to {entry['app']}, the focus is now on {app}")
+        logging.info(f"Undo refused: focus moved from {entry['app']} to {app}")
+        return False
+    try:
+        get_injector().tap("backspace", entry["chars"])
+    except Exception as e:
+        print(f"[ERROR] Undo failed: {e}")
+        logging.error(f"Undo failed: {e}")
+        return False
+    journal.mark_undone(entry)
+    logging.info(f"Undid {entry['chars']} character(s): {entry['text']!r}")
+    return True
+
+
+def record_trace(trace, inference_s, audio_s):
+    durations = trace.durations()
+    for name, value in durations.items():
+        metrics.observe(name, value)
+    values = dict(durations)
+    if audio_s > 0:
+        values["rtf"] = inference_s / audio_s
+        metrics.observe("rtf", values["rtf"])
+    if trace.info.get("tokens") and inference_s > 0:
+        values["tokens_per_s"] = trace.info["tokens"] / inference_s
+        metrics.observe("tokens_per_s", values["tokens_per_s"])
+    values["cpu_percent"] = current_process.cpu_percent(None)
+    values["rss_mb"] = current_process.memory_info().rss / 1e6
+    metrics.gauge("cpu_percent", values["cpu_percent"])
+    metrics.gauge("rss_mb", values["rss_mb"])
+    metrics.inc("utterances_total", path=trace.info.get("path", "full"))
+    if bus.has_subscribers("latency"):
+        # Rolling percentiles ride along so remote panels need no extra request
+        p = {name: metrics.percentiles(name) for name in durations}
+        bus.publish("latency", dict(values, audio_ms=audio_s * 1000, p50={k: v[0.5] for k, v in p.items()},
+                                    p95={k: v[0.95] for k, v in p.items()}))
+    if metrics_log is not None:
+        metrics_log.write(dict(trace.info, type="utterance", ts=round(trace.marks["vad_close"], 3),
+                               **{k: round(v, 3) for k, v in values.items()}))
+
+
+class MetricsLog:
+    # JSONL export: one record per utterance plus a rolling-percentile summary
+    # every summary_interval_s. The file is rotated to .1 at max_bytes.
+    def __init__(self, path, max_bytes, summary_interval):
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+        self.summary_interval = summary_interval
+        self.last_summary = time.time()
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+    def write(self, record):
+        records = [record]
+        if time.time() - self.last_summary >= self.summary_interval:
+            self.last_summary = time.time()
+            records.append({"type": "summary", "ts": round(self.last_summary, 3), "metrics": metrics.summary()})
+        with self.lock:
+            try:
+                if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+                with open(self.path, "a") as f:
+                    for r in records:
+                        f.write(json.dumps(r, separators=(",", ":")) + "\n")
+            except OSError as e:
+                logging.error(f"Could not write metrics to {self.path}: {e}")
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_metrics_log(settings):
+    if not settings.get("enabled", True) or not settings.get("jsonl_path"):
+        return None
+    return MetricsLog(settings["jsonl_path"], settings.get("jsonl_max_bytes", 5000000),
+                      settings.get("summary_interval_s", 60))
+
+
+def start_metrics_exporters(settings):
+    global metrics_log
+    if not settings.get("enabled", True):
+        return
+    metrics_log = make_metrics_log(settings)
+    port = int(settings.get("prometheus_port", 0))
+    if port:
+        try:
+            server = http.server.ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+        except OSError as e:
+            logging.error(f"Could not serve metrics on port {port}: {e}")
+            return
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        logging.info(f"Serving Prometheus metrics on http://127.0.0.1:{port}/metrics")
+
+
+current_process = psutil.Process()
+metrics_log = None
+
+
+def set_partial(text):
+    global partial_transcript
+    partial_transcript = text[-200:]
+    bus.set_state(partial=partial_transcript)
+
+
+def streaming_enabled():
+    return listening and mode == "dictation" and config.get("streaming", {}).get("enabled", False)
+
+
+def configure_pipeline():
+    # (Re)build the per-utterance state process_utterance works with from the
+    # current config; bench calls it again after applying its overrides.
+    global streamer, command_registry, command_recognizer, prompt_context, wake_word
+    streamer = StreamingDictation(config.get("streaming", {}))
+    prompt_context = PromptContext(config.get("prompting", {}))
+    command_registry = build_command_registry()
+    command_recognizer = None
+    if config.get("command_recognizer", {}).get("enabled", True):
+        command_recognizer = CommandRecognizer(config.get("command_recognizer", {}), config.get("asr", {}),
+                                               fp16=config.get("use_fp16", False))
+    wake_word = make_wake_word(config.get("wake_word", {}))
+
+
+configure_pipeline()
+partial_transcript = ""
+
+
+inference_lock = threading.Lock()
+
+
+def pipeline_loop(capture, get_engine, stop=None):
+    # Runs until stop is set and the capture queue is empty (forever if no
+    # stop event is given). get_engine is asked for the engine per utterance
+    # so a model reloaded by a settings change is picked up.
+    while stop is None or not stop.is_set() or capture.queue_depth():
+        streaming = streaming_enabled()
+        timeout = streamer.step if streaming else (0.2 if stop is not None else None)
+        try:
+            utterance = capture.chunks.get(timeout=timeout)
+        except queue.Empty:
+            if streaming:
+                audio, utterance_id = capture.current_speech()
+                if audio is not None:
+                    try:
+                        with inference_lock:
+                            streamer.update(get_engine(), audio, utterance_id)
+                    except Exception as e:
+                        print(f"[ERROR] Streaming update failed: {e}")
+                        logging.error(f"Streaming update failed: {e}")
+                    set_partial(streamer.tail())
+            continue
+        capture.publish_queue()
+        backlog = capture.queue_depth()
+        if backlog:
+            logging.info(f"Transcription backlog: {backlog} utterance(s) waiting")
+        # One failed utterance (a backend error, a bad command) must not end
+        # the pipeline thread of a long-running daemon
+        try:
+            with inference_lock:
+                process_utterance(get_engine(), utterance)
+        except Exception as e:
+            print(f"[ERROR] Processing utterance failed: {e}")
+            logging.error(f"Processing utterance failed: {e}")
+
+
+def wait_for_models():
+    # Blocks until the current model is ready. After a failed load it waits
+    # for reload_models to swap in a working one once settings.json is fixed;
+    # utterances heard meanwhile are dropped rather than left to pile up.
+    failed = None
+    while True:
+        current = models
+        try:
+            if current.get(timeout=0.5) is not None:
+                return
+        except RuntimeError as e:
+            if failed is not current:
+                failed = current
+                print(f"[ERROR] {e}; waiting for a working asr setting")
+                logging.error(f"{e}; waiting for a working asr setting")
+            dropped = 0
+            while True:
+                try:
+                    capture.chunks.get_nowait()
+                except queue.Empty:
+                    break
+                dropped += 1
+            if dropped:
+                logging.info(f"Dropped {dropped} utterance(s) heard without a model")
+                capture.publish_queue()
+            time.sleep(0.5)
+
+
+def dictation_loop():
+    logging.info("Dictation loop started.")
+    try:
+        capture.start()
+    except Exception as e:
+        print(f"[ERROR] Dictation pipeline could not start: {e}")
+        logging.error(f"Dictation pipeline could not start: {e}")
+        return
+    wait_for_models()
+    pipeline_loop(capture, lambda: models.get())
+
+
+# Live configuration: the daemon watches settings.json and the commands file
+# and reinitializes only the subsystems whose settings changed. Settings read
+# where they are used (mouse_step, app aliases, batch, debug) need no handler.
+config_handlers = []
+config_watcher = None
+
+
+def on_config_change(sections, callback):
+    config_handlers.append((set(sections), callback))
+
+
+def reload_config():
+    changed = config.load()
+    if changed:
+        logging.info(f"Settings changed: {', '.join(sorted(changed))}")
+        bus.publish("config", {"changed": sorted(changed), "errors": config.errors})
+    for sections, callback in config_handlers:
+        if sections & changed:
+            try:
+                callback()
+            except Exception as e:
+                logging.error(f"Applying {', '.join(sorted(sections & changed))} settings failed: {e}")
+                print(f"[ERROR] Applying {', '.join(sorted(sections & changed))} settings failed: {e}")
+    return sorted(changed)
+
+
+def reload_models():
+    # The new model loads next to the current one, which keeps serving until
+    # the swap; if it fails the current one stays
+    new_models = ModelManager(config.get("asr", {}), fp16=config.get("use_fp16", False),
+                              cascade=config.get("cascade", {}))
+
+    def swap():
+        global models
+        try:
+            new_models.get()
+        except RuntimeError as e:
+            logging.error(f"Keeping the current model: {e}")
+            models.set_state(models.state)
+            return
+        models = new_models
+
+    new_models.start()
+    threading.Thread(target=swap, name="model-swap", daemon=True).start()
+
+
+def reload_commands():
+    global command_registry
+    command_registry = build_command_registry()
+    if command_recognizer is not None:
+        command_recognizer.set_phrases(command_phrases())
+    if config_watcher is not None:
+        config_watcher.watch(commands_path(), reload_commands)
+
+
+def reload_command_recognizer():
+    # Until the new model is ready recognize() returns None and commands
+    # take the full decode
+    global command_recognizer
+    recognizer = None
+    if config.get("command_recognizer", {}).get("enabled", True):
+        recognizer = CommandRecognizer(config.get("command_recognizer", {}), config.get("asr", {}),
+                                       fp16=config.get("use_fp16", False))
+        recognizer.start()
+    command_recognizer = recognizer
+
+
+def reload_streaming():
+    global streamer
+    with inference_lock:
+        streamer = StreamingDictation(config.get("streaming", {}))
+
+
+def reload_prompting():
+    global prompt_context
+    context = PromptContext(config.get("prompting", {}))
+    context.history = prompt_context.history
+    prompt_context = context
+
+
+def reload_audio_processing():
+    # Swapped between blocks; the new VAD carries on the old one's sample
+    # clock and utterance numbering
+    vad = make_vad(config.get("vad", {}))
+    preprocessor = make_suppressor(config.get("noise_suppression", {}))
+    with capture.segment_lock:
+        vad.position = capture.vad.position
+        vad.utterance_id = capture.vad.utterance_id
+        vad.pending = capture.vad.pending
+        capture.vad = vad
+        capture.preprocessor = preprocessor
+
+
+def reload_injector():
+    release_all_keys()
+    set_injector(None)
+
+
+def reload_metrics():
+    global metrics_log
+    metrics_log = make_metrics_log(config.get("metrics", {}))
+    logging.info("A new metrics window or Prometheus port takes effect after a restart.")
+
+
+def reload_wake_word():
+    global wake_word
+    detector = make_wake_word(config.get("wake_word", {}))
+    if detector is not None:
+        detector.start()
+    wake_word = detector
+
+
+def reload_journal():
+    global journal
+    new_journal = Journal(config.get("journal", {}))
+    new_journal.recent.extend(journal.recent)
+    journal = new_journal
+
+
+def restart_needed():
+    logging.info("Audio device and daemon settings take effect after a restart.")
+    print("[INFO] Audio device and daemon settings take effect after a restart.")
+
+
+on_config_change(("asr", "use_fp16", "cascade"), reload_models)
+on_config_change(("commands_file", "app_aliases"), reload_commands)
+on_config_change(("asr", "use_fp16", "command_recognizer"), reload_command_recognizer)
+on_config_change(("streaming",), reload_streaming)
+on_config_change(("prompting",), reload_prompting)
+on_config_change(("vad", "noise_suppression"), reload_audio_processing)
+on_config_change(("asr", "use_fp16", "command_recognizer", "wake_word"), reload_wake_word)
+on_config_change(("injection",), reload_injector)
+on_config_change(("metrics",), reload_metrics)
+on_config_change(("journal",), reload_journal)
+on_config_change(("audio", "daemon"), restart_needed)
+
+
+def start_config_watcher():
+    global config_watcher
+    config_watcher = ConfigWatcher()
+    config_watcher.watch(config.path, reload_config)
+    config_watcher.watch(commands_path(), reload_commands)
+    config_watcher.start()
+
+
+# Control API: the daemon owns the model and the audio pipeline; the widget
+# and `ctl` talk to it with newline-delimited JSON-RPC 2.0 over a Unix socket
+# (localhost TCP on Windows).
+def control_address():
+    settings = config.get("daemon", {})
+    if sys.platform.startswith("win"):
+        return ("127.0.0.1", int(settings.get("port", 47631)))
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or os.path.expanduser("~/.cache")
+    return os.path.expanduser(settings.get("socket") or os.path.join(runtime_dir, "whisper-dictate.sock"))
+
+
+# The Unix socket is private to the user by its file mode. The Windows TCP
+# port is open to every local process, so there each connection must first
+# "auth" with a random token the daemon writes to a file only the user can
+# read (under %LOCALAPPDATA%, private to the user).
+def control_token_path():
+    base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~/.cache")
+    return os.path.expanduser(config.get("daemon", {}).get("token_file") or os.path.join(base, "whisper-dictate.token"))
+
+
+def write_control_token():
+    token = secrets.token_hex(32)
+    path = control_token_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        os.unlink(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+    return token
 
-startup_mode = config.get("startup_mode", "dictation")
-startup_listening = config.get("startup_listening", "asleep")
-mode = startup_mode
-listening = startup_listening == "awake"
 
-log_path = os.path.expanduser("~/.local/share/whisper-dictation.log")
-os.makedirs(os.path.dirname(log_path), exist_ok=True)
-logging.basicConfig(filename=log_path, level=logging.INFO, format="%(asctime)s %(message)s")
+def read_control_token():
+    with open(control_token_path()) as f:
+        return f.read().strip()
 
-import torch
-import torch
 
-try:
-    if torch.cuda.is_available():
-        logging.info("Loading Whisper model in FP32 on GPU.")
-        model = whisper.load_model("small").to("cuda").to(dtype=torch.float32)
-    else:
-        logging.info("Loading Whisper model in FP32 on CPU.")
-        model = whisper.load_model("small").to("cpu").to(dtype=torch.float32)
-except Exception as e:
-    logging.error(f"Model loading failed: {e}")
-    model = whisper.load_model("small").to("cpu").to(dtype=torch.float32)
-
-    logging.info("Loading Whisper model in FP16 on GPU.")
-    model = whisper.load_model("small").to("cuda").half()
-else:
-    logging.info("Loading Whisper model in FP32 on CPU.")
-    model = whisper.load_model("small")
+def connect_control(address=None, timeout=5):
+    address = address or control_address()
+    sock = socket.socket(socket.AF_UNIX if isinstance(address, str) else socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        raise
+    return sock
 
-sample_rate = 16000
-duration = 5
 
-key_map = {
-    "ctrl": pynput.keyboard.Key.ctrl,
-    "alt": pynput.keyboard.Key.alt,
-    "shift": pynput.keyboard.Key.shift,
-    "super": pynput.keyboard.Key.cmd,
-    "delete": pynput.keyboard.Key.delete,
-    "backspace": pynput.keyboard.Key.backspace,
-    "tab": pynput.keyboard.Key.tab,
-    "enter": pynput.keyboard.Key.enter,
-    "escape": pynput.keyboard.Key.esc,
-    "space": pynput.keyboard.Key.space,
-    "delete": pynput.keyboard.Key.delete,
-    "left": pynput.keyboard.Key.left,
-    "right": pynput.keyboard.Key.right,
-    "up": pynput.keyboard.Key.up,
-    "down": pynput.keyboard.Key.down,
-}
+def rpc_get_state():
+    return dict(bus.state, mode=mode, listening=listening, model=models.state, last_transcript=last_transcript,
+                partial=partial_transcript, held_keys=sorted(held_keys))
 
-nato_map = {
-    "alpha": "a", "bravo": "b", "charlie": "c", "delta": "d", "echo": "e", "foxtrot": "f",
-    "golf": "g", "hotel": "h", "india": "i", "juliett": "j", "kilo": "k", "lima": "l",
-    "mike": "m", "november": "n", "oscar": "o", "papa": "p", "quebec": "q", "romeo": "r",
-    "sierra": "s", "tango": "t", "uniform": "u", "victor": "v", "whiskey": "w",
-    "x-ray": "x", "yankee": "y", "zulu": "z"
-}
-spoken_aliases = {'semicolon': ';', 'colon': ':', 'comma': ',', 'period': '.', 'dot': '.', 'slash': '/', 'backslash': '\\', 'quote': "'", 'double quote': '"', 'apostrophe': "'", 'dash': '-', 'minus': '-', 'equals': '=', 'plus': '+', 'underscore': '_', 'tilde': '~', 'grave': '`', 'backtick': '`', 'exclamation': '!', 'at': '@', 'hash': '#', 'pound': '#', 'dollar': '$', 'percent': '%', 'caret': '^', 'ampersand': '&', 'asterisk': '*', 'star': '*', 'pipe': '|', 'open bracket': '[', 'close bracket': ']', 'open brace': '{', 'close brace': '}', 'open paren': '(', 'close paren': ')', 'less than': '<', 'greater than': '>', 'question mark': '?'}
 
+def rpc_wake():
+    set_listening(True)
+    return rpc_get_state()
 
-held_keys = set()
-kb = pynput.keyboard.Controller()
-mouse = MouseController()
-mouse_held = False
-last_transcript = ""
 
-def type_text(text):
-    for char in text:
-        kb.type(char)
+def rpc_sleep():
+    set_listening(False)
+    return rpc_get_state()
 
-def parse_key_combo(text):
-    words = text.strip().lower().split()
-    return [key_map.get(w, w) for w in words]
 
-def press_keys(keys):
+def rpc_toggle():
+    set_listening(not listening)
+    return rpc_get_state()
+
+
+def rpc_set_mode(mode):
+    if mode not in ("dictation", "command"):
+        raise ValueError(f"unknown mode '{mode}'")
+    set_mode(mode)
+    return rpc_get_state()
+
+
+def rpc_stats():
+    managers = [models] + ([command_recognizer.models] if command_recognizer is not None else [])
+    if isinstance(wake_word, WhisperWakeWord) and wake_word.models not in managers:
+        managers.append(wake_word.models)
+    return {
+        "capture": capture.stats(),
+        "models": {m.name: dict(m.metrics, state=m.state) for m in managers},
+        "command_recognizer": command_recognizer.stats if command_recognizer is not None else None,
+        "cascade": models.engine.stats if isinstance(models.engine, CascadeEngine) else None,
+        "wake_word": dict(wake_word.stats, backend=type(wake_word).__name__) if wake_word is not None else None,
+        "metrics": metrics.summary(),
+    }
+
+
+def rpc_transcribe_file(path):
+    audio = load_audio_file(os.path.expanduser(path))
+    engine = models.get()
+    start = time.perf_counter()
+    with inference_lock:
+        text = segments_text(engine.transcribe(audio, language="en"))
+    return {"text": text, "audio_s": len(audio) / sample_rate, "seconds": time.perf_counter() - start}
+
+
+def rpc_transcribe_batch(paths, workers=None):
+    # Separate engines from the live one, loaded for this request only
+    settings = batch_settings(workers)
+    transcriber = BatchTranscriber(config.get("asr", {}), settings, config.get("use_fp16", False))
     try:
-        for k in keys:
-            kb.press(k)
-        for k in reversed(keys):
-            kb.release(k)
-    except Exception as e:
-        print(f"[ERROR] Keypress failed: {e}")
+        return batch_transcribe(transcriber, [os.path.expanduser(p) for p in paths], settings.get("max_shard_s", 30))
+    finally:
+        transcriber.close()
 
-def hold_key(key_name):
-    key = key_map.get(key_name, key_name)
-    if key not in held_keys:
+
+def rpc_journal(search=None, mode=None, since=None, limit=50):
+    return journal.query(search, mode, since, int(limit))
+
+
+def rpc_undo():
+    return undo_last()
+
+
+def rpc_reload_config():
+    return {"changed": reload_config(), "errors": config.errors}
+
+
+def rpc_shutdown():
+    # shutdown() waits for serve_forever, so it can't run on a handler thread
+    threading.Thread(target=control_server.shutdown, daemon=True).start()
+    return True
+
+
+rpc_methods = {
+    "ping": lambda: "pong",
+    "get_state": rpc_get_state,
+    "wake": rpc_wake,
+    "sleep": rpc_sleep,
+    "toggle": rpc_toggle,
+    "set_mode": rpc_set_mode,
+    "stats": rpc_stats,
+    "transcribe_file": rpc_transcribe_file,
+    "transcribe_batch": rpc_transcribe_batch,
+    "reload_config": rpc_reload_config,
+    "journal": rpc_journal,
+    "undo": rpc_undo,
+    "shutdown": rpc_shutdown,
+}
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    # One client connection. Requests are answered in order; after
+    # "subscribe" the connection also carries "event" notifications. All
+    # output goes through a bounded queue drained by a writer thread, so a
+    # slow client never blocks the thread that published an event.
+    default_topics = ("state", "model", "queue", "latency")
+
+    def setup(self):
+        super().setup()
+        self.outbox = queue.Queue(maxsize=1000)
+        self.topics = []
+        self.closed = False
+        self.dropped = 0
+        self.authenticated = getattr(self.server, "token", None) is None
+        self.writer = threading.Thread(target=self._write_loop, name="control-writer", daemon=True)
+        self.writer.start()
+
+    def _write_loop(self):
+        while True:
+            data = self.outbox.get()
+            if data is None:
+                return
+            if self.closed:
+                continue
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except (OSError, ValueError):
+                self.closed = True
+
+    def send(self, message, block=True):
+        data = (json.dumps(message, default=str, separators=(",", ":")) + "\n").encode()
+        if block:
+            self.outbox.put(data)
+            return
         try:
-            kb.press(key)
-            held_keys.add(key)
-        except Exception as e:
-            print(f"[ERROR] Failed to hold {key_name}: {e}")
+            self.outbox.put_nowait(data)
+        except queue.Full:
+            self.dropped += 1
 
-def release_all_keys():
-    for k in list(held_keys):
+    def forward(self, topic, data):
+        self.send({"jsonrpc": "2.0", "method": "event", "params": {"topic": topic, "data": data}}, block=False)
+
+    def subscribe(self, topics=None):
+        for topic in topics or self.default_topics:
+            if topic not in self.topics:
+                bus.subscribe(topic, self.forward)
+                self.topics.append(topic)
+        return self.topics
+
+    def authenticate(self, token):
+        if not hmac.compare_digest(str(token).encode(), self.server.token.encode()):
+            raise ValueError("invalid token")
+        self.authenticated = True
+        return True
+
+    def handle(self):
+        for line in self.rfile:
+            if line.strip():
+                response = self.dispatch(line)
+                if response is not None:
+                    self.send(response)
+
+    def dispatch(self, line):
         try:
-            kb.release(k)
-        except:
-            pass
-    held_keys.clear()
+            request = json.loads(line)
+        except ValueError as e:
+            return {"jsonrpc": "2.0", "id": None, "error": {"code": -32700, "message": f"parse error: {e}"}}
+        # Batches aren't supported; like any other non-object they get an
+        # error and the connection stays open
+        if isinstance(request, list):
+            return {"jsonrpc": "2.0", "id": None, "error": {"code": -32600, "message": "invalid request: batches are not supported"}}
+        if (not isinstance(request, dict) or not isinstance(request.get("method"), str)
+                or not isinstance(request.get("params") or {}, (dict, list))):
+            request_id = request.get("id") if isinstance(request, dict) else None
+            return {"jsonrpc": "2.0", "id": request_id, "error": {"code": -32600, "message": "invalid request"}}
+        request_id = request.get("id")
+        method = request.get("method")
+        params = request.get("params") or {}
+        args, kwargs = (params, {}) if isinstance(params, list) else ((), params)
+        func = {"subscribe": self.subscribe, "auth": self.authenticate}.get(method) or rpc_methods.get(method)
+        if not self.authenticated and method != "auth":
+            error = {"code": -32001, "message": "authentication required"}
+        elif func is None:
+            error = {"code": -32601, "message": f"unknown method '{method}'"}
+        else:
+            try:
+                inspect.signature(func).bind(*args, **kwargs)
+            except TypeError as e:
+                error = {"code": -32602, "message": f"invalid params for '{method}': {e}"}
+            else:
+                try:
+                    result = func(*args, **kwargs)
+                    error = None
+                except Exception as e:
+                    logging.error(f"Control request '{method}' failed: {e}")
+                    error = {"code": -32000, "message": str(e)}
+        if "id" not in request:
+            return None
+        if error is not None:
+            return {"jsonrpc": "2.0", "id": request_id, "error": error}
+        return {"jsonrpc": "2.0", "id": request_id, "result": result}
 
+    def finish(self):
+        for topic in self.topics:
+            bus.unsubscribe(topic, self.forward)
+        if self.dropped:
+            logging.info(f"Control client dropped {self.dropped} event(s)")
+        # Let queued responses go out before the stream is closed
+        self.outbox.put(None)
+        self.writer.join(timeout=5)
+        super().finish()
 
 
+class DaemonClient:
+    # Blocking JSON-RPC client for the daemon's control socket
+    def __init__(self, address=None, timeout=5):
+        address = address or control_address()
+        self.sock = connect_control(address, timeout)
+        self.file = self.sock.makefile("rwb")
+        self.next_id = 0
+        self.lock = threading.Lock()
+        if not isinstance(address, str):
+            try:
+                self.call("auth", token=read_control_token())
+            except (OSError, RuntimeError) as e:
+                self.close()
+                raise ConnectionRefusedError(f"authentication failed: {e}")
 
+    def call(self, method, **params):
+        with self.lock:
+            self.next_id += 1
+            request = {"jsonrpc": "2.0", "id": self.next_id, "method": method, "params": params}
+            self.file.write((json.dumps(request) + "\n").encode())
+            self.file.flush()
+            while True:
+                line = self.file.readline()
+                if not line:
+                    raise ConnectionError("the dictation daemon closed the connection")
+                response = json.loads(line)
+                if response.get("id") == self.next_id:
+                    break
+        if "error" in response:
+            raise RuntimeError(response["error"]["message"])
+        return response["result"]
 
+    def events(self, topics=None):
+        # Subscribe, then yield (topic, data) until the daemon goes away
+        self.call("subscribe", topics=topics)
+        self.sock.settimeout(None)
+        for line in self.file:
+            message = json.loads(line)
+            if message.get("method") == "event":
+                yield message["params"]["topic"], message["params"]["data"]
 
+    def close(self):
+        self.file.close()
+        self.sock.close()
 
-def launch_app(app_name: str):
-    # Look up alias first
-    target = config.get("app_aliases", {}).get(app_name, app_name)
-    try:
-        if sys.platform.startswith("win"):
-            # Use 'start' to resolve PATH / App Paths
-            subprocess.Popen(["cmd", "/c", "start", "", target], shell=False)
-        else:
-            # On POSIX, try launching directly (user can map aliases to full paths)
-            subprocess.Popen([target], shell=False)
-        logging.info(f"Launched app: {target}")
-    except Exception as e:
-        logging.error(f"Failed to launch '{app_name}' -> {target}: {e}")
-        print(f"[ERROR] Failed to open {app_name}: {e}")
 
-def close_app(app_name: str):
-    # Try to match process by alias target first, then by given name (substring match, case-insensitive)
-    names_to_match = {app_name.lower()}
-    alias_target = config.get("app_aliases", {}).get(app_name, None)
-    if alias_target:
-        names_to_match.add(Path(alias_target).name.lower())
-
-    matched = 0
-    for p in psutil.process_iter(["name"]):
+control_server = None
+control_client = None
+
+
+def run_daemon():
+    global control_server
+    address = control_address()
+    if isinstance(address, str):
         try:
-            pname = (p.info.get("name") or "").lower()
-            if any(n in pname for n in names_to_match):
-                p.terminate()
-                matched += 1
-        except Exception:
-            continue
-    # Fallback: force kill if still alive
-    if matched:
-        gone, alive = psutil.wait_procs([pr for pr in psutil.process_iter() if any(n in (getattr(pr, "name", lambda: "")() or "").lower() for n in names_to_match)], timeout=1)
-        for pr in alive:
-            try:
-                pr.kill()
-            except Exception:
-                pass
-    if matched == 0:
-        print(f"[INFO] No running process matched '{app_name}'.")
+            connect_control(address, timeout=1).close()
+            print(f"[ERROR] A dictation daemon is already listening on {address}")
+            return 1
+        except OSError:
+            pass
+        if os.path.exists(address):
+            os.unlink(address)
+        os.makedirs(os.path.dirname(address), exist_ok=True)
+        control_server = socketserver.ThreadingUnixStreamServer(address, ControlHandler, bind_and_activate=False)
     else:
-        print(f"[INFO] Closed {matched} process(es) for '{app_name}'.")
+        control_server = socketserver.ThreadingTCPServer(address, ControlHandler, bind_and_activate=False)
+    control_server.daemon_threads = True
+    try:
+        control_server.server_bind()
+        if not isinstance(address, str):
+            # Written before listening, so no client can read a stale token
+            control_server.token = write_control_token()
+        control_server.server_activate()
+    except OSError as e:
+        print(f"[ERROR] Could not listen on {address}: {e}")
+        logging.error(f"Could not listen on {address}: {e}")
+        return 1
+    if isinstance(address, str):
+        os.chmod(address, 0o600)
 
+    stop = lambda sig, frame: threading.Thread(target=control_server.shutdown, daemon=True).start()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    start_metrics_exporters(config.get("metrics", {}))
+    models.start()
+    if command_recognizer is not None:
+        command_recognizer.start()
+    if wake_word is not None:
+        wake_word.start()
+    threading.Thread(target=dictation_loop, name="dictation", daemon=True).start()
+    start_config_watcher()
+    # Build the process index now so the first "close <app>" doesn't pay for it
+    threading.Thread(target=process_index.refresh, name="process-index", daemon=True).start()
+    logging.info(f"Dictation daemon listening on {address}")
+    try:
+        control_server.serve_forever()
+    finally:
+        control_server.server_close()
+        release_all_keys()
+        capture.stop()
+        if isinstance(address, str) and os.path.exists(address):
+            os.unlink(address)
+        logging.info("Dictation daemon stopped.")
+    return 0
 
-def handle_command(text):
-    text = spoken_aliases.get(text, text)
-    words = text.strip().lower().split()
 
-    if text.startswith("hold ") and len(words) == 2:
-        hold_key(words[1])
-    elif text.startswith("press ") and len(words) == 2:
-        key = key_map.get(words[1], words[1])
-        try:
-            kb.press(key)
-            kb.release(key)
-        except Exception as e:
-            print(f"[ERROR] Failed to press {words[1]}: {e}")
-            logging.error(f"Failed to press {words[1]}: {e}")
-    elif text.startswith("select line ") and len(words) == 3 and words[2].isdigit():
-        line_num = int(words[2])
-        try:
-            for _ in range(line_num):
-                kb.press(key_map.get("home", pynput.keyboard.Key.home))
-                kb.release(key_map.get("home", pynput.keyboard.Key.home))
-                kb.press(key_map.get("shift", pynput.keyboard.Key.shift))
-                kb.press(key_map.get("down", pynput.keyboard.Key.down))
-                kb.release(key_map.get("down", pynput.keyboard.Key.down))
-                kb.release(key_map.get("shift", pynput.keyboard.Key.shift))
-        except Exception as e:
-            print(f"[ERROR] Failed to select line: {e}")
-            logging.error(f"Failed to select line: {e}")
-    elif text.startswith("select word ") and len(words) == 3:
-        try:
-            kb.press(key_map.get("ctrl", pynput.keyboard.Key.ctrl))
-            for _ in range(100):
-                kb.press(key_map.get("left", pynput.keyboard.Key.left))
-                kb.release(key_map.get("left", pynput.keyboard.Key.left))
-            kb.release(key_map.get("ctrl", pynput.keyboard.Key.ctrl))
-
-            kb.press(key_map.get("shift", pynput.keyboard.Key.shift))
-            for _ in range(100):
-                kb.press(key_map.get("right", pynput.keyboard.Key.right))
-                kb.release(key_map.get("right", pynput.keyboard.Key.right))
-            kb.release(key_map.get("shift", pynput.keyboard.Key.shift))
-        except Exception as e:
-            print(f"[ERROR] Failed to select word: {e}")
-            logging.error(f"Failed to select word: {e}")
+def run_daemon_self_test():
+    # Serve the control protocol on a throwaway localhost port (with a
+    # token, as on Windows) and send it malformed and valid requests on one
+    # connection: every line must be answered and the connection must stay
+    # usable. No model is loaded and no pipeline runs.
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), ControlHandler, bind_and_activate=False)
+    server.daemon_threads = True
+    server.token = secrets.token_hex(16)
+    server.server_bind()
+    server.server_activate()
+    threading.Thread(target=server.serve_forever, name="self-test", daemon=True).start()
+    cases = [
+        ('{"jsonrpc":"2.0","id":1,"method":"ping"}', {"code": -32001}),
+        (json.dumps({"jsonrpc": "2.0", "id": 2, "method": "auth", "params": {"token": "wrong"}}), {"code": -32000}),
+        (json.dumps({"jsonrpc": "2.0", "id": 3, "method": "auth", "params": {"token": server.token}}), {"result": True}),
+        ("[]", {"code": -32600, "id": None}),
+        ("[1]", {"code": -32600, "id": None}),
+        ('"x"', {"code": -32600, "id": None}),
+        ("42", {"code": -32600, "id": None}),
+        ("{not json", {"code": -32700, "id": None}),
+        ('{"jsonrpc":"2.0","id":4,"method":["ping"]}', {"code": -32600, "id": 4}),
+        ('{"jsonrpc":"2.0","id":5,"method":"ping","params":"x"}', {"code": -32600, "id": 5}),
+        ('{"jsonrpc":"2.0","id":6,"method":"no_such_method"}', {"code": -32601, "id": 6}),
+        ('{"jsonrpc":"2.0","id":7,"method":"ping","params":{"extra":1}}', {"code": -32602, "id": 7}),
+        ('{"jsonrpc":"2.0","id":8,"method":"ping"}', {"result": "pong", "id": 8}),
+    ]
+    failures = 0
+    try:
+        sock = connect_control(server.server_address, timeout=5)
+        stream = sock.makefile("rwb")
+        for line, expected in cases:
+            try:
+                stream.write(line.encode() + b"\n")
+                stream.flush()
+                answer = stream.readline()
+                response = json.loads(answer) if answer else None
+            except OSError as e:
+                response = None
+                logging.debug(f"Self-test request failed: {e}")
+            got = None
+            if response is not None:
+                got = {"id": response.get("id"), "result": response.get("result"),
+                       "code": (response.get("error") or {}).get("code")}
+            ok = got is not None and all(got[key] == value for key, value in expected.items())
+            if not ok:
+                failures += 1
+                print(f"[FAIL] {line} -> {answer.decode().strip() if response is not None else 'no answer'}")
+        stream.close()
+        sock.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+    print(f"{len(cases)} request(s), {failures} failure(s)")
+    return 1 if failures else 0
 
-    elif text.startswith("open "):
-        app = text.split("open ", 1)[1].strip()
-        if app:
-            launch_app(app)
-    elif text.startswith("close "):
-        app = text.split("close ", 1)[1].strip()
-        if app:
-            close_app(app)
 
-    elif "release keys" in text:
-        release_all_keys()
-    elif all(w in nato_map for w in words):
-        spelled = ''.join(nato_map[w] for w in words)
-        type_text(spelled)
-    elif len(words) >= 2 and words[0] in key_map and "click" not in words:
-        combo = parse_key_combo(text)
-        press_keys(combo)
-    elif text in key_map:
-        press_keys([key_map[text]])
-    elif len(text) == 1 and text in r"!@#$%^&*()_+-={}[]|\:;\"'<>,.?/~`":
-        try:
-            kb.press(text)
-            kb.release(text)
-        except Exception as e:
-            print(f"[ERROR] Failed to press symbol {text}: {e}")
-            logging.error(f"Failed to press symbol {text}: {e}")
-    elif text == "copy":
-        press_keys([key_map["ctrl"], 'c'])
-    elif text == "paste":
-        press_keys([key_map["ctrl"], 'v'])
-    elif text == "select all":
-        press_keys([key_map["ctrl"], 'a'])
-    
-    elif text.startswith("move mouse"):
-        # Support: "move mouse left 1000" or "move mouse 1000 left" or no amount (uses settings)
-        dirs = {"left": (-1, 0), "right": (1, 0), "up": (0, -1), "down": (0, 1)}
-        direction = None
-        amount = None
-        # find direction anywhere
-        for i, w in enumerate(words):
-            if w in dirs:
-                direction = w
-                # amount may be next or previous token
-                if i + 1 < len(words) and words[i + 1].isdigit():
-                    amount = int(words[i + 1])
-                elif i - 1 >= 0 and words[i - 1].isdigit():
-                    amount = int(words[i - 1])
-                break
-        if amount is None:
-            amount = int(config.get("mouse_step", 50))
-        if direction:
-            dx, dy = dirs[direction]
-            mouse.move(dx * amount, dy * amount)
-
-    elif text == "click":
-        mouse.click(MouseButton.left)
-    elif text == "double click":
-        mouse.click(MouseButton.left, 2)
-    elif text in ("left click", "left mouse click"):
-        mouse.click(MouseButton.left)
-    elif text in ("left double click", "double left click"):
-        mouse.click(MouseButton.left, 2)
-
-    elif text == "right click":
-        mouse.click(MouseButton.right)
-    elif text == "middle click":
-        mouse.click(MouseButton.middle)
-    elif text == "scroll up":
-        mouse.scroll(0, 2)
-    elif text == "scroll down":
-        mouse.scroll(0, -2)
-    elif text == "hold click":
-        global mouse_held
+def ensure_daemon(timeout=30):
+    # Connect to the running daemon, starting one in the background first
+    # if nothing answers
+    try:
+        return DaemonClient()
+    except OSError:
+        if not config.get("daemon", {}).get("autostart", True):
+            raise
+    logging.info("No dictation daemon running; starting one.")
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), "daemon"], stdin=subprocess.DEVNULL,
+                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    deadline = time.time() + timeout
+    while True:
+        time.sleep(0.1)
         try:
-            mouse.press(MouseButton.left)
-            mouse_held = True
-        except Exception as e:
-            print(f"[ERROR] Failed to hold click: {e}")
+            return DaemonClient()
+        except OSError:
+            if time.time() > deadline:
+                raise
+
 
-    elif text == "release click":
+def daemon_call(method, **params):
+    # UI-side request: errors are reported rather than raised so a restarted
+    # or missing daemon doesn't take the widget down
+    global control_client
+    for attempt in range(2):
         try:
-            mouse.release(MouseButton.left)
-            mouse_held = False
-        except Exception as e:
-            print(f"[ERROR] Failed to release click: {e}")
+            if control_client is None:
+                control_client = DaemonClient()
+            return control_client.call(method, **params)
+        except OSError as e:
+            control_client = None
+            error = e
+        except (RuntimeError, ValueError) as e:
+            error = e
+            break
+    print(f"[ERROR] Daemon request '{method}' failed: {error}")
+    logging.error(f"Daemon request '{method}' failed: {error}")
+    return None
 
 
+class DaemonEvents:
+    # Replays the daemon's events for topics on the local bus, so the widgets
+    # render from bus.state exactly as they would in-process. Reconnects if
+    # the daemon restarts; close() ends the subscription, and with it the
+    # daemon's publishing for topics nobody else wants (level, queue, ...).
+    def __init__(self, topics):
+        self.topics = topics
+        self.client = None
+        self.stopped = threading.Event()
+        threading.Thread(target=self._run, name="daemon-events", daemon=True).start()
 
+    def _run(self):
+        tracks_state = "state" in self.topics
+        while not self.stopped.is_set():
+            try:
+                self.client = DaemonClient()
+                if self.stopped.is_set():
+                    self.client.close()
+                    return
+                if tracks_state:
+                    bus.set_state(**self.client.call("get_state"), connected=True)
+                for topic, data in self.client.events(self.topics):
+                    if topic == "state":
+                        bus.set_state(**data)
+                        continue
+                    if topic == "model" and data.get("name") == "asr":
+                        bus.set_state(model=data["state"])
+                    bus.publish(topic, data)
+            except (OSError, ValueError) as e:
+                logging.debug(f"Daemon event stream ended: {e}")
+            if tracks_state:
+                bus.set_state(connected=False)
+            self.stopped.wait(1)
+        if self.client is not None:
+            self.client.close()
 
-def normalize_command(text):
-    return re.sub(r"[^a-zA-Z0-9 -]+", "", text.strip().lower())
+    def close(self):
+        self.stopped.set()
+        if self.client is not None:
+            try:
+                self.client.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
 
-def dictation_loop():
-    logging.info("Dictation loop started.")
-    global listening, mode
-    while True:
-        logging.debug("Recording audio...")
-        logging.debug("Recording audio...")
-        audio = sd.rec(int(duration * sample_rate), samplerate=sample_rate, channels=1)
-        sd.wait()
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmpfile:
-            filename = tmpfile.name
-            scipy.io.wavfile.write(filename, sample_rate, audio)
-        try:
-            logging.debug(f"Transcribing audio file: {filename}")
-            result = model.transcribe(filename, language='en')
-            logging.debug(f"Transcription result: {{result}}")
-            text = result["text"].strip()
-            norm = normalize_command(text)
-            print(f"Transcript: {text}")
-            global last_transcript
-            last_transcript = text[:200]
-            if "wake up" in norm or "start listening" in norm:
-                listening = True
-            elif "stop listening" in norm:
-                listening = False
-            elif "command mode" in norm:
-                mode = "command"
-            elif "dictation mode" in norm:
-                mode = "dictation"
-            elif listening:
-                if mode == "dictation":
-                    type_text(text)
-                elif mode == "command":
-                    handle_command(norm)
-        finally:
-            time.sleep(0.5)
-            try:
-                os.remove(filename)
-            except PermissionError:
-                print(f"[WARNING] Could not delete temp file: {filename}")
+def run_journal(search=None, mode=None, hours=None, limit=20, as_json=False):
+    # Review the journal from the files, without the daemon
+    since = time.time() - hours * 3600 if hours else None
+    entries = journal.query(search, mode, since, limit)
+    if as_json:
+        print(json.dumps(entries, indent=2))
+        return 0
+    for e in entries:
+        when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(e["ts"]))
+        flags = " (undone)" if e.get("undone") else ""
+        print(f"{when}  {e.get('mode', '-'):<9} {e.get('action', '-'):<9} {e.get('latency_ms', 0):>6.0f}ms  "
+              f"{e.get('chars', 0):>4} chars  {e.get('text', '').strip()}{flags}")
+    return 0
+
+
+def run_ctl(method, assignments):
+    params = {}
+    for assignment in assignments:
+        key, _, raw = assignment.partition("=")
+        params[key] = parse_value(raw)
+    try:
+        client = DaemonClient(timeout=None)
+        if method == "subscribe":
+            for topic, data in client.events(params.get("topics")):
+                print(json.dumps({"topic": topic, "data": data}, default=str), flush=True)
+            return 0
+        result = client.call(method, **params)
+    except KeyboardInterrupt:
+        return 0
+    except OSError as e:
+        print(f"[ERROR] Could not reach the dictation daemon at {control_address()}: {e}")
+        return 1
+    except RuntimeError as e:
+        print(f"[ERROR] {method} failed: {e}")
+        return 1
+    print(json.dumps(result, indent=2, default=str))
+    return 0
+
 
 # UI Widget
+class QtBridge(QtCore.QObject):
+    # Re-emits bus events as a Qt signal. The signal is emitted on the worker
+    # thread and delivered through a queued connection on the GUI thread.
+    event = QtCore.pyqtSignal(str, object)
+
+    def __init__(self, topics):
+        super().__init__()
+        self.topics = topics
+        for topic in topics:
+            bus.subscribe(topic, self.forward)
+
+    def forward(self, topic, data):
+        self.event.emit(topic, data)
+
+    def close(self):
+        for topic in self.topics:
+            bus.unsubscribe(topic, self.forward)
+
+
 class DictationWidget(QtWidgets.QWidget):
     def __init__(self):
         super().__init__()
@@ -401,19 +4016,33 @@ class DictationWidget(QtWidgets.QWidget):
         self.close_button.clicked.connect(QtWidgets.QApplication.quit)
         self.close_button.setStyleSheet("font-size: 14px; background-color: transparent; color: white;")
 
+        # Repaint only when the pipeline reports a change
+        self.bridge = QtBridge(["state"])
+        self.bridge.event.connect(self.on_event)
+
         self.update_text()
         self.show()
 
+    def on_event(self, topic, data):
+        self.update_text()
+
     def mousePressEvent(self, event):
-        global mode
         if event.button() == QtCore.Qt.LeftButton and event.pos().x() < 400:
-            mode = "command" if mode == "dictation" else "dictation"
-            self.update_text()
+            daemon_call("set_mode", mode="command" if bus.state.get("mode") == "dictation" else "dictation")
 
     def update_text(self):
-        self.label.setText(f"Mode: {mode.title()}\nListening: {'Yes' if listening else 'No'}\n\nLast heard: {last_transcript}")
-        if held_keys:
-            readable_keys = ', '.join(str(k).split('.')[-1] for k in held_keys)
+        # Everything shown here is the daemon's state, mirrored onto bus.state
+        state = dict(bus.state)
+        status = f"Mode: {state.get('mode', 'dictation').title()}\nListening: {'Yes' if state.get('listening') else 'No'}"
+        if not state.get("connected"):
+            status += "\nDaemon: not connected"
+        elif state.get("model") != "ready":
+            status += f"\nModel: {state.get('model')}"
+        self.label.setText(f"{status}\n\nLast heard: {state.get('last_transcript', '')}")
+        if state.get("partial"):
+            self.label.setText(f"{self.label.text()}\nHearing: {state['partial']}")
+        if state.get("held_keys"):
+            readable_keys = ', '.join(state["held_keys"])
             self.keys_label.setText(f"Held Keys: {readable_keys}")
         else:
             self.keys_label.setText("Held Keys: None")
@@ -424,19 +4053,83 @@ class DictationWidget(QtWidgets.QWidget):
 
 
 class DebugWindow(QtWidgets.QWidget):
+    # Live pipeline panel: state, queue depth, per-stage latency and input level
+    stages = ("vad_ms", "queue_ms", "inference_ms", "dispatch_ms", "injection_ms", "end_to_end_ms")
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Live Debug")
-        self.resize(400, 200)
-        self.label = QtWidgets.QLabel("Listening...", self)
-        self.label.setGeometry(10, 10, 380, 180)
-        self.timer = QtCore.QTimer()
-        self.timer.timeout.connect(self.update_debug)
-        self.timer.start(1000)
+        self.resize(420, 320)
+        self.state_label = QtWidgets.QLabel()
+        self.queue_label = QtWidgets.QLabel()
+        self.model_label = QtWidgets.QLabel()
+        self.latency_label = QtWidgets.QLabel("No utterances yet")
+        self.latency_label.setStyleSheet("font-family: monospace;")
+        self.level_bar = QtWidgets.QProgressBar()
+        self.level_bar.setRange(-60, 0)
+        self.level_bar.setFormat("%v dBFS")
+        self.level_bar.setValue(-60)
+        layout = QtWidgets.QVBoxLayout()
+        for w in (self.state_label, self.queue_label, self.model_label, self.latency_label):
+            layout.addWidget(w)
+        layout.addWidget(QtWidgets.QLabel("Input level:"))
+        layout.addWidget(self.level_bar)
+        self.setLayout(layout)
+
+        self.bridge = QtBridge(["state", "model", "queue", "latency", "level"])
+        self.bridge.event.connect(self.on_event)
+        self.events = DaemonEvents(["queue", "latency", "level"])
+        self.update_state()
+        stats = daemon_call("stats")
+        if stats:
+            self.update_queue(stats["capture"])
+            self.update_model(stats["models"].get("asr", {}))
         self.show()
 
-    def update_debug(self):
-        self.label.setText(f"Mode: {mode}\nListening: {'Yes' if listening else 'No'}")
+    def on_event(self, topic, data):
+        if topic == "state":
+            self.update_state()
+        elif topic == "model" and data["name"] == "asr":
+            self.update_model(data)
+        elif topic == "queue":
+            self.update_queue(data)
+        elif topic == "latency":
+            self.update_latency(data)
+        elif topic == "level":
+            self.level_bar.setValue(data)
+
+    def update_state(self):
+        state = dict(bus.state)
+        self.state_label.setText(f"Mode: {state.get('mode')}\nListening: {'Yes' if state.get('listening') else 'No'}")
+
+    def update_queue(self, stats):
+        self.queue_label.setText(
+            f"Queue depth: {stats['queue_depth']} (max {stats['max_queue_depth']})\n"
+            f"Ring fill: {stats['ring_fill'] / sample_rate:.1f}s, overruns: {stats['overruns']}"
+        )
+
+    def update_model(self, info):
+        self.model_label.setText(
+            f"Model: {info.get('state')}, load {info.get('load_seconds', 0):.1f}s, "
+            f"warm-up {info.get('first_inference_seconds', 0):.2f}s"
+        )
+
+    def update_latency(self, data):
+        lines = [
+            f"Last utterance: {data['audio_ms'] / 1000:.1f}s of audio, RTF {data.get('rtf', 0):.2f}",
+            f"{'stage':<12}{'last':>9}{'p50':>9}{'p95':>9}",
+        ]
+        for stage in self.stages:
+            if stage not in data:
+                continue
+            p50, p95 = data["p50"][stage], data["p95"][stage]
+            lines.append(f"{stage[:-3]:<12}{data[stage]:>7.0f}ms{p50:>7.0f}ms{p95:>7.0f}ms")
+        self.latency_label.setText("\n".join(lines))
+
+    def closeEvent(self, event):
+        self.events.close()
+        self.bridge.close()
+        super().closeEvent(event)
 
 class TrainingWindow(QtWidgets.QDialog):
     def __init__(self):
@@ -521,25 +4214,809 @@ class SettingsWindow(QtWidgets.QDialog):
         
 
     def save_config(self):
-        config["startup_listening"] = self.listenBox.currentText()
-        config["startup_mode"] = self.modeBox.currentText()
-        config["noise_suppression"]["enabled"] = self.noiseCheck.isChecked()
-        config["use_fp16"] = self.fp16Check.isChecked()
-        config["mouse_step"] = int(self.mouseStepSpin.value())
-        with open(config_path, "w") as f:
-            json.dump(config, f, indent=2)
+        # The daemon's watcher picks the file up and applies it
+        config.save({
+            "startup_listening": self.listenBox.currentText(),
+            "startup_mode": self.modeBox.currentText(),
+            "noise_suppression": {"enabled": self.noiseCheck.isChecked()},
+            "use_fp16": self.fp16Check.isChecked(),
+            "mouse_step": int(self.mouseStepSpin.value()),
+        })
         self.accept()
 
-def update_widget_periodically(widget):
-    while True:
-        widget.update_text()
-        time.sleep(1)
+def word_error_rate(reference, hypothesis):
+    ref = normalize_command(reference).split()
+    hyp = normalize_command(hypothesis).split()
+    if not ref:
+        return 0.0 if not hyp else 1.0
+    prev = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        cur = [i] + [0] * len(hyp)
+        for j, h in enumerate(hyp, 1):
+            cur[j] = min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (r != h))
+        prev = cur
+    return prev[-1] / len(ref)
 
-if __name__ == "__main__":
+
+def run_parity(files, engine_names, model_size=None, max_wer=0.15):
+    # Run every engine over the same fixtures; a fixture's reference transcript,
+    # if present, is the .txt file next to the .wav.
+    engines = []
+    for name in engine_names:
+        settings = dict(config.get("asr", {}), engine=name)
+        if model_size:
+            settings["model"] = model_size
+        eng = make_engine(settings, config.get("use_fp16", False))
+        eng.load()
+        engines.append(eng)
+    failures = 0
+    for path in files:
+        audio = load_audio_file(path)
+        ref_path = os.path.splitext(path)[0] + ".txt"
+        reference = None
+        if os.path.exists(ref_path):
+            with open(ref_path) as f:
+                reference = f.read().strip()
+        texts = []
+        print(f"{path} ({len(audio) / sample_rate:.1f}s)")
+        for eng in engines:
+            start = time.perf_counter()
+            text = segments_text(eng.transcribe(audio, language="en"))
+            elapsed = time.perf_counter() - start
+            texts.append(text)
+            line = f"  {eng.describe():<32} {elapsed:6.2f}s  {text}"
+            if reference is not None:
+                line += f"  [WER {word_error_rate(reference, text):.2f}]"
+            print(line)
+        for eng, text in zip(engines[1:], texts[1:]):
+            wer = word_error_rate(texts[0], text)
+            if wer > max_wer:
+                failures += 1
+                print(f"  [MISMATCH] {eng.describe()} vs {engines[0].describe()}: WER {wer:.2f} > {max_wer:.2f}")
+    print(f"{len(files)} fixture(s), {failures} mismatch(es)")
+    return 1 if failures else 0
+
+
+def run_command_check(bench_rounds=0, show=False):
+    # Parse one example of every registered pattern and make sure it comes
+    # back as that pattern (nothing shadows it). Only the parser runs; no
+    # handler is called, so no keys are pressed.
+    failures = 0
+    examples = []
+    for command in command_registry.commands:
+        example = command.example()
+        examples.append(example)
+        found = command_registry.parse(example)
+        got = found[0] if found else None
+        if show:
+            print(f"{command.pattern:<40} {example!r} -> {found[1] if found else None}")
+        if got is not command:
+            failures += 1
+            print(f"[FAIL] '{example}' ({command.pattern}) parsed as {got.pattern if got else None!r}")
+            continue
+        try:
+            inspect.signature(command.handler).bind(**found[1])
+        except TypeError as e:
+            failures += 1
+            print(f"[FAIL] '{command.pattern}' handler does not accept {sorted(found[1])}: {e}")
+    # User commands that run themselves, directly or through each other,
+    # must stop at the nesting limit rather than recurse until Python gives up
+    loops = CommandRegistry()
+    for entry in ({"phrase": "again", "command": "again"},
+                  {"phrase": "ping", "command": "pong"}, {"phrase": "pong", "command": "ping"}):
+        loops.register(entry["phrase"], user_command_handler(entry, loops), source="check")
+    for phrase in ("again", "ping"):
+        try:
+            loops.dispatch(phrase)
+        except RecursionError:
+            failures += 1
+            print(f"[FAIL] self-referencing user command '{phrase}' recursed without limit")
+        if getattr(command_expansion, "depth", 0):
+            failures += 1
+            print(f"[FAIL] nesting depth left at {command_expansion.depth} after '{phrase}'")
+            command_expansion.depth = 0
+    print(f"{len(command_registry.commands)} command(s), {failures} failure(s)")
+    if bench_rounds:
+        start = time.perf_counter()
+        for _ in range(bench_rounds):
+            for example in examples:
+                command_registry.parse(example)
+        elapsed = time.perf_counter() - start
+        per_parse = elapsed / (bench_rounds * len(examples)) * 1e6
+        print(f"{bench_rounds * len(examples)} parses in {elapsed:.3f}s ({per_parse:.1f} us/parse)")
+    return 1 if failures else 0
+
+
+class SyntheticProcess:
+    # Process-table entry for the index benchmark
+    def __init__(self, pid, name):
+        self.pid = pid
+        self._name = name
+        self.running = True
+
+    def name(self):
+        return self._name
+
+    def is_running(self):
+        return self.running
+
+
+def run_process_bench(synthetic=0, rounds=1000, app_name="firefox"):
+    # Compares the old full process_iter scan with the index: a cold build,
+    # warm lookups and an incremental refresh after 1% of processes change
+    if synthetic:
+        table = {pid: SyntheticProcess(pid, f"proc{pid % 700}") for pid in range(1000, 1000 + synthetic)}
+        for pid in range(1000, 1000 + synthetic, max(1, synthetic // 5)):
+            table[pid] = SyntheticProcess(pid, app_name)
+
+        def open_process(pid):
+            if pid not in table:
+                raise psutil.NoSuchProcess(pid)
+            return table[pid]
+
+        index = ProcessIndex(ttl=3600, list_pids=lambda: list(table), open_process=open_process)
+        scan = lambda: [p for p in table.values() if app_name in p.name().lower()]
+    else:
+        index = ProcessIndex(ttl=3600)
+        scan = lambda: [p for p in psutil.process_iter(["name"]) if app_name in (p.info["name"] or "").lower()]
+    print(f"{len(index.list_pids())} process(es) ({'synthetic' if synthetic else 'real'}), looking up '{app_name}'")
+
+    scans = max(1, min(rounds, 20))
+    start = time.perf_counter()
+    for _ in range(scans):
+        scan()
+    print(f"  full scan:           {(time.perf_counter() - start) / scans * 1000:9.3f} ms/lookup")
+
+    start = time.perf_counter()
+    index.refresh(force=True)
+    print(f"  index build (cold):  {(time.perf_counter() - start) * 1000:9.3f} ms")
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        found = index.find({app_name})
+    print(f"  indexed lookup:      {(time.perf_counter() - start) / rounds * 1000:9.3f} ms/lookup ({len(found)} match(es))")
+
+    if synthetic:
+        # Replace 1% of the table, as between two refreshes of a busy desktop
+        churn = max(1, synthetic // 100)
+        for pid in list(table)[:churn]:
+            del table[pid]
+        top = max(table) + 1
+        for pid in range(top, top + churn):
+            table[pid] = SyntheticProcess(pid, f"proc{pid % 700}")
+    start = time.perf_counter()
+    index.refresh(force=True)
+    print(f"  incremental refresh: {(time.perf_counter() - start) * 1000:9.3f} ms")
+
+    if synthetic:
+        # A recycled PID (one of the app's, reused by another program) and a
+        # process that exec()s into the app must both be re-keyed, whether
+        # the index is refreshed first or the lookup finds them stale
+        failures = 0
+        for refresh_first in (True, False):
+            recycled = next(pid for pid, p in table.items() if p.name() == app_name)
+            table[recycled].running = False
+            table[recycled] = SyntheticProcess(recycled, "recycled")
+            execed = next(pid for pid, p in table.items() if p.name() != app_name and p.name() != "recycled")
+            table[execed]._name = app_name
+            if refresh_first:
+                index.refresh(force=True)
+            found = sorted(p.pid for p in index.find({app_name}))
+            expected = sorted(pid for pid, p in table.items() if p.name() == app_name)
+            if refresh_first and found != expected:
+                failures += 1
+                print(f"[FAIL] after refresh: found {found}, expected {expected}")
+            if not refresh_first and recycled in found:
+                failures += 1
+                print(f"[FAIL] stale lookup returned recycled PID {recycled}: {found}")
+        print(f"  stale entries:       {'ok' if not failures else f'{failures} failure(s)'}")
+        return 1 if failures else 0
+    return 0
+
+
+class ReplayStream:
+    # Stand-in for sounddevice.InputStream: plays an array into the capture
+    # callback one block at a time, paced at `speed` x real time.
+    def __init__(self, audio, speed=1.0, samplerate=16000, blocksize=1600, callback=None, **kwargs):
+        self.audio = audio
+        self.speed = speed
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        self.callback = callback
+        self.active = False
+        self.finished = threading.Event()
+
+    def start(self):
+        self.active = True
+        threading.Thread(target=self._run, name="replay", daemon=True).start()
+
+    def _run(self):
+        start = time.monotonic()
+        for pos in range(0, len(self.audio), self.blocksize):
+            if not self.active:
+                break
+            block = np.zeros((self.blocksize, 1), dtype=np.float32)
+            chunk = self.audio[pos:pos + self.blocksize]
+            block[:len(chunk), 0] = chunk
+            # A device delivers a block once it has been recorded
+            delay = start + (pos + self.blocksize) / (self.samplerate * self.speed) - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.callback(block, self.blocksize, None, None)
+        self.finished.set()
+
+    def stop(self):
+        self.active = False
+
+    def close(self):
+        pass
+
+
+def load_bench_fixtures(directory):
+    # <dir>/dictation/*.wav and <dir>/command/*.wav (WAVs directly in <dir>
+    # count as dictation), each with a same-named .txt reference transcript.
+    fixtures = []
+    for sub, fixture_mode in (("", "dictation"), ("dictation", "dictation"), ("command", "command")):
+        folder = os.path.join(directory, sub)
+        if not os.path.isdir(folder):
+            continue
+        for name in sorted(os.listdir(folder)):
+            if not name.lower().endswith(".wav"):
+                continue
+            path = os.path.join(folder, name)
+            ref_path = os.path.splitext(path)[0] + ".txt"
+            if not os.path.exists(ref_path):
+                print(f"[INFO] Skipping {path}: no reference transcript")
+                continue
+            with open(ref_path) as f:
+                fixtures.append({"path": path, "mode": fixture_mode, "reference": f.read().strip()})
+    return fixtures
+
+
+def record_events(fixture_mode, action):
+    # Run action() awake in fixture_mode against a fresh RecordingInjector and
+    # return what it injected. Held keys and buttons are let go at the end.
+    recorder = RecordingInjector()
+    previous = injector
+    set_injector(recorder)
+    set_listening(True)
+    set_mode(fixture_mode)
+    try:
+        action()
+        release_all_keys()
+        if mouse_held:
+            release_click()
+    finally:
+        set_injector(previous)
+    return recorder.log
+
+
+def dispatch_reference(text):
+    # What the pipeline would do with a perfect transcript
+    norm = normalize_command(text)
+    if apply_control(norm):
+        return
+    if mode == "dictation":
+        type_text(text)
+    else:
+        handle_command(norm)
+
+
+def replay_audio(engine, audio, speed):
+    # Feed audio through capture -> VAD -> process_utterance, with silence on
+    # both ends so the VAD has a noise floor and closes the last utterance.
+    padded = np.concatenate([np.zeros(sample_rate // 2, dtype=np.float32), audio,
+                             np.zeros(sample_rate, dtype=np.float32)])
+    ring = max(ring_seconds, int(len(padded) / sample_rate) + 1)
+    replay = AudioCapture(sample_rate, block_size, ring, make_vad(config.get("vad", {})),
+                          stream_factory=lambda **kwargs: ReplayStream(padded, speed, **kwargs), time_scale=speed,
+                          preprocessor=make_suppressor(config.get("noise_suppression", {})))
+    stop = threading.Event()
+    worker = threading.Thread(target=pipeline_loop, args=(replay, lambda: engine, stop), name="bench-pipeline", daemon=True)
+    replay.start()
+    stream = replay.stream
+    worker.start()
+    stream.finished.wait()
+    replay.stop()
+    stop.set()
+    worker.join()
+
+
+def parse_value(raw):
+    # JSON when it parses as JSON, a plain string otherwise
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return raw
+
+
+def parse_setting(assignment):
+    # "vad.hangover_ms=400" -> {"vad": {"hangover_ms": 400}}
+    key, _, raw = assignment.partition("=")
+    value = parse_value(raw)
+    for part in reversed(key.split(".")):
+        value = {part: value}
+    return value
+
+
+def load_asleep_fixtures(directory):
+    # <dir>/idle/*.wav is background audio not meant for the tool (20 s of
+    # quiet noise if there is none), <dir>/wake/*.wav the wake phrase; no
+    # transcripts needed
+    def wavs(name):
+        folder = os.path.join(directory, name)
+        if not os.path.isdir(folder):
+            return []
+        return [load_audio_file(os.path.join(folder, n)) for n in sorted(os.listdir(folder)) if n.lower().endswith(".wav")]
+
+    idle = wavs("idle")
+    if not idle:
+        idle = [np.random.default_rng(0).normal(0, 0.001, 20 * sample_rate).astype(np.float32)]
+    return idle, wavs("wake")
+
+
+def bench_asleep(engine, idle, wake, speed):
+    # CPU time per second of background audio while asleep, as a fraction of
+    # one core, how many idle clips wrongly woke the pipeline and how many
+    # wake clips did
+    previous = injector
+    set_injector(RecordingInjector())
+    cpu = audio_s = 0.0
+    false_wakes = woke = 0
+    try:
+        for audio in idle:
+            set_listening(False)
+            before = sum(current_process.cpu_times()[:2])
+            replay_audio(engine, audio, speed)
+            cpu += sum(current_process.cpu_times()[:2]) - before
+            audio_s += len(audio) / sample_rate
+            false_wakes += listening
+        for audio in wake:
+            set_listening(False)
+            replay_audio(engine, audio, speed)
+            woke += listening
+    finally:
+        set_injector(previous)
+    return {"idle_cpu": cpu / audio_s, "false_wakes": false_wakes, "idle_clips": len(idle),
+            "wake_rate": woke / len(wake) if wake else None}
+
+
+def bench_run(fixtures, speed, idle=(), wake=()):
+    # One pass over every fixture with the current config; returns the
+    # engine-independent results of that pass
+    global metrics, journal
+    previous_metrics, previous_journal = metrics, journal
+    metrics = Metrics(window=100000)
+    journal = Journal({"enabled": False})
+    try:
+        engine = ModelManager(config.get("asr", {}), fp16=config.get("use_fp16", False), name="bench",
+                              cascade=config.get("cascade", {})).get()
+        if command_recognizer is not None:
+            command_recognizer.models.get()
+        if wake_word is not None:
+            wake_word.start()
+            wake_word.wait()
+        errors = words = 0
+        commands = commands_ok = 0
+        audio_s = 0.0
+        for fixture in fixtures:
+            audio = load_audio_file(fixture["path"])
+            audio_s += len(audio) / sample_rate
+            streamer.reset(None)
+            got = record_events(fixture["mode"], lambda: replay_audio(engine, audio, speed))
+            if fixture["mode"] == "dictation":
+                # Each utterance is typed on its own, without a leading space;
+                # joined blind, one's last word would run into the next's first
+                typed = " ".join(event[1].strip() for event in got if event[0] == "type")
+                n = len(normalize_command(fixture["reference"]).split())
+                errors += word_error_rate(fixture["reference"], typed) * n
+                words += n
+                detail = f"WER {word_error_rate(fixture['reference'], typed):.2f}  {typed!r}"
+            else:
+                expected = record_events("command", lambda: dispatch_reference(fixture["reference"]))
+                commands += 1
+                commands_ok += got == expected
+                detail = "ok" if got == expected else f"expected {expected}, got {got}"
+            print(f"  {fixture['path']}: {detail}")
+        latency = metrics.percentiles("end_to_end_ms")
+        inference_s = metrics.sums[("inference_ms", ())] / 1000
+        cascade = {}
+        if isinstance(engine, CascadeEngine):
+            decodes = engine.stats["accepted"] + engine.stats["escalated"]
+            cascade = {"escalation_rate": engine.stats["escalated"] / decodes if decodes else None,
+                       "cascade_saved_ms": engine.stats["saved_ms"] / decodes if decodes else None}
+        asleep = bench_asleep(engine, idle, wake, speed) if idle else {}
+        return {
+            "engine": engine.describe(),
+            "fixtures": len(fixtures),
+            "wer": errors / words if words else None,
+            "command_accuracy": commands_ok / commands if commands else None,
+            "p50_ms": latency[0.5],
+            "p95_ms": latency[0.95],
+            "rtf": inference_s / audio_s if audio_s else None,
+            "utterances": metrics.counts[("end_to_end_ms", ())],
+            **cascade,
+            **asleep,
+        }
+    finally:
+        metrics, journal = previous_metrics, previous_journal
+
+
+def run_bench(directory, engine_names, model_sizes, overlays=(), settings=(), speed=1.0, output=None):
+    # Replay the fixtures once per engine x model x config overlay, headless:
+    # audio comes from ReplayStream, output goes to a RecordingInjector.
+    fixtures = load_bench_fixtures(directory)
+    if not fixtures:
+        print(f"[ERROR] No fixtures with reference transcripts in {directory}")
+        return 1
+    idle, wake = load_asleep_fixtures(directory)
+    base = json.loads(json.dumps(config))
+    for assignment in settings:
+        merge_settings(base, parse_setting(assignment))
+    variants = [("default", {})]
+    if overlays:
+        variants = []
+        for path in overlays:
+            with open(path) as f:
+                variants.append((os.path.splitext(os.path.basename(path))[0], json.load(f)))
+    original = json.loads(json.dumps(config))
+    results = []
+    failures = 0
+    try:
+        for label, overlay in variants:
+            for engine_name in engine_names or [base.get("asr", {}).get("engine", "whisper")]:
+                for model_size in model_sizes or [base.get("asr", {}).get("model", "small")]:
+                    config.clear()
+                    config.update(merge_settings(json.loads(json.dumps(base)), overlay))
+                    config["asr"] = dict(config.get("asr", {}), engine=engine_name, model=model_size)
+                    configure_pipeline()
+                    print(f"[{label}] {engine_name} {model_size}: {len(fixtures)} fixture(s) at {speed:g}x")
+                    try:
+                        result = bench_run(fixtures, speed, idle, wake)
+                    except RuntimeError as e:
+                        failures += 1
+                        print(f"[ERROR] {e}")
+                        continue
+                    results.append(dict(result, config=label, model=model_size))
+    finally:
+        config.clear()
+        config.update(original)
+        configure_pipeline()
+
+    def fmt(value, spec):
+        return format(value, spec) if value is not None else format("-", ">" + re.match(r"\d*", spec).group())
+
+    print(f"{'config':<12} {'engine':<36} {'WER':>6} {'cmd acc':>8} {'p50 ms':>8} {'p95 ms':>8} {'RTF':>6} "
+          f"{'escalated':>9} {'idle CPU':>8} {'false wakes':>11} {'wake rate':>9}")
+    for r in results:
+        print(f"{r['config']:<12} {r['engine']:<36} {fmt(r['wer'], '6.3f')} {fmt(r['command_accuracy'], '8.2%')} "
+              f"{fmt(r['p50_ms'], '8.0f')} {fmt(r['p95_ms'], '8.0f')} {fmt(r['rtf'], '6.3f')} "
+              f"{fmt(r.get('escalation_rate'), '9.0%')} {fmt(r.get('idle_cpu'), '8.1%')} {r.get('false_wakes', '-'):>11} {fmt(r.get('wake_rate'), '9.0%')}")
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 1 if failures else 0
+
+
+def record_clips(count, max_s):
+    # count utterances from the microphone, cut by the VAD
+    recorder = AudioCapture(sample_rate, block_size, ring_seconds, make_vad(config.get("vad", {})),
+                            preprocessor=make_suppressor(config.get("noise_suppression", {})))
+    recorder.start()
+    clips = []
+    try:
+        while len(clips) < count:
+            print(f"Say the wake phrase ({len(clips) + 1}/{count})...")
+            try:
+                utterance = recorder.chunks.get(timeout=15)
+            except queue.Empty:
+                print("[ERROR] Heard nothing for 15 seconds")
+                break
+            if utterance.duration() > max_s:
+                print(f"[INFO] That was {utterance.duration():.1f}s, longer than wake_word.max_audio_s; again please")
+                continue
+            clips.append(utterance.audio)
+    finally:
+        recorder.stop()
+    return clips
+
+
+def run_enroll(count=3, files=()):
+    # Record (or import) wake phrase templates, then set template_threshold
+    # from how far apart they are and switch the wake word to templates
+    settings = config.get("wake_word", {})
+    directory = os.path.expanduser(settings.get("templates_dir", "~/.local/share/whisper-dictation/wake"))
+    if files:
+        clips = [load_audio_file(path) for path in files]
+    else:
+        clips = record_clips(count, settings.get("max_audio_s", 2.5))
+    if not clips:
+        return 1
+    os.makedirs(directory, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    for i, clip in enumerate(clips):
+        scipy.io.wavfile.write(os.path.join(directory, f"wake-{stamp}-{i}.wav"), sample_rate, clip.astype(np.float32))
+    detector = TemplateWakeWord(settings)
+    distances = [detector.distance(a, b) for i, a in enumerate(detector.templates) for b in detector.templates[i + 1:]]
+    distances = [d for d in distances if math.isfinite(d)]
+    if not distances:
+        print(f"[INFO] {len(detector.templates)} template(s) in {directory}; enroll at least two to calibrate")
+        threshold = settings.get("template_threshold", 0.3)
+    else:
+        threshold = round(max(distances) * 1.5, 3)
+        print(f"{len(detector.templates)} template(s) in {directory}: distances between them "
+              f"{min(distances):.3f}-{max(distances):.3f}, threshold {threshold}")
+    config.save({"wake_word": {"backend": "templates", "template_threshold": threshold}})
+    return 0
+
+
+def shard_audio(audio, max_shard_s=30):
+    # Sample ranges to transcribe, cut at VAD boundaries: consecutive
+    # utterances are merged while the shard stays within max_shard_s
+    # (Whisper's window) and silence between shards is skipped.
+    vad = make_vad(config.get("vad", {}))
+    utterances = []
+    for pos in range(0, len(audio), block_size):
+        utterances.extend(vad.process(audio[pos:pos + block_size]))
+    last = vad.flush()
+    if last is not None:
+        utterances.append(last)
+    max_samples = int(max_shard_s * sample_rate)
+    shards = []
+    for u in utterances:
+        start, end = u.start_sample, u.start_sample + len(u.audio)
+        if shards and end - shards[-1][0] <= max_samples:
+            shards[-1] = (shards[-1][0], end)
+        else:
+            shards.append((start, end))
+    return shards
+
+
+def batch_workers(settings):
+    cores = os.cpu_count() or 1
+    workers = int(settings.get("workers") or 0) or max(1, cores // 4)
+    threads = int(settings.get("threads_per_worker") or 0) or max(1, cores // workers)
+    return workers, threads
+
+
+batch_engine = None
+
+
+def batch_worker_init(engine_settings, fp16, threads):
+    # Runs once in each pool process: pin the BLAS/torch thread count so N
+    # workers don't oversubscribe the cores, then load the worker's engine
+    global batch_engine
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    batch_engine = make_engine(engine_settings, fp16)
+    batch_engine.load()
+
+
+def batch_worker_transcribe(audio):
+    return batch_engine.transcribe(audio, language="en")
+
+
+class BatchTranscriber:
+    # Transcribes many shards at once, results in submission order. openai-
+    # whisper gets a process pool with one engine per worker; faster-whisper
+    # shares one model between threads (CTranslate2 runs num_workers decodes
+    # concurrently and releases the GIL while it does).
+    def __init__(self, asr_settings, settings, fp16=False):
+        self.workers, self.threads = batch_workers(settings)
+        self.backend = settings.get("backend", "auto")
+        if self.backend == "auto":
+            self.backend = "thread" if asr_settings.get("engine") == "faster-whisper" else "process"
+        engine_settings = dict(asr_settings, cpu_threads=self.threads, num_workers=self.workers)
+        self.engine = None
+        if self.backend == "thread":
+            self.engine = make_engine(engine_settings, fp16)
+            self.engine.load()
+            self.pool = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="batch")
+        else:
+            # spawn, not fork: the parent has audio, Qt and CUDA threads running
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                self.workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=batch_worker_init, initargs=(engine_settings, fp16, self.threads))
+
+    def warm_up(self):
+        # Start every worker and load its model before anything is timed
+        silence = [np.zeros(sample_rate, dtype=np.float32)] * self.workers
+        self.transcribe(silence)
+
+    def transcribe(self, shards):
+        # Longest shards first so the pool doesn't end on one long straggler
+        order = sorted(range(len(shards)), key=lambda i: -len(shards[i]))
+        if self.engine is not None:
+            futures = {i: self.pool.submit(self.engine.transcribe, shards[i], language="en") for i in order}
+        else:
+            futures = {i: self.pool.submit(batch_worker_transcribe, shards[i]) for i in order}
+        return [futures[i].result() for i in range(len(shards))]
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def batch_transcribe(transcriber, paths, max_shard_s=30):
+    # One result per file, in order: shards from all files go through the
+    # pool together and segment times are shifted back to file time
+    results = []
+    shards, owners = [], []
+    for index, path in enumerate(paths):
+        audio = load_audio_file(path)
+        suppressor = make_suppressor(config.get("noise_suppression", {}))
+        if suppressor is not None:
+            audio = suppressor.process_all(audio)
+        results.append({"path": path, "audio_s": len(audio) / sample_rate, "segments": []})
+        for start, end in shard_audio(audio, max_shard_s):
+            shards.append(audio[start:end])
+            owners.append((index, start / sample_rate))
+    for (index, offset), segments in zip(owners, transcriber.transcribe(shards)):
+        for seg in segments:
+            results[index]["segments"].append(dict(seg, start=seg["start"] + offset, end=seg["end"] + offset))
+    for result in results:
+        result["text"] = segments_text(result["segments"])
+    return results
+
+
+def batch_settings(workers=None, threads=None):
+    settings = dict(config.get("batch", {}))
+    if workers:
+        settings["workers"] = workers
+    if threads:
+        settings["threads_per_worker"] = threads
+    return settings
+
+
+def run_batch(paths, workers=None, threads=None, output_dir=None, as_json=False):
+    settings = batch_settings(workers, threads)
+    transcriber = BatchTranscriber(config.get("asr", {}), settings, config.get("use_fp16", False))
+    print(f"{transcriber.backend} pool: {transcriber.workers} worker(s) x {transcriber.threads} thread(s)")
+    try:
+        start = time.perf_counter()
+        results = batch_transcribe(transcriber, paths, settings.get("max_shard_s", 30))
+        elapsed = time.perf_counter() - start
+    finally:
+        transcriber.close()
+    for result in results:
+        body = json.dumps(result, indent=2) if as_json else result["text"] + "\n"
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+            name = os.path.splitext(os.path.basename(result["path"]))[0] + (".json" if as_json else ".txt")
+            with open(os.path.join(output_dir, name), "w") as f:
+                f.write(body)
+        else:
+            print(f"== {result['path']} ({result['audio_s']:.1f}s)")
+            print(body)
+    audio_s = sum(r["audio_s"] for r in results)
+    print(f"{len(results)} file(s), {audio_s:.1f}s of audio in {elapsed:.1f}s ({audio_s / elapsed:.1f}x real time)")
+    return 0
+
+
+def run_batch_scaling(paths, max_workers=None, threads=None):
+    # Same files at 1, 2, 4, ... workers with a fixed thread count per worker;
+    # model loading and warm-up are excluded from the timings
+    settings = batch_settings(max_workers, threads)
+    max_workers, threads = batch_workers(settings)
+    counts = [1]
+    while counts[-1] * 2 < max_workers:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != max_workers:
+        counts.append(max_workers)
+    baseline = None
+    print(f"{'workers':>7} {'threads':>7} {'seconds':>8} {'x real time':>11} {'speedup':>8} {'efficiency':>10}")
+    for count in counts:
+        transcriber = BatchTranscriber(config.get("asr", {}), dict(settings, workers=count, threads_per_worker=threads),
+                                       config.get("use_fp16", False))
+        try:
+            transcriber.warm_up()
+            start = time.perf_counter()
+            results = batch_transcribe(transcriber, paths, settings.get("max_shard_s", 30))
+            elapsed = time.perf_counter() - start
+        finally:
+            transcriber.close()
+        audio_s = sum(r["audio_s"] for r in results)
+        baseline = baseline or elapsed
+        speedup = baseline / elapsed
+        print(f"{count:>7} {threads:>7} {elapsed:>8.2f} {audio_s / elapsed:>11.1f} {speedup:>8.2f} {speedup / count:>10.0%}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Whisper dictation with voice commands")
+    sub = parser.add_subparsers(dest="command")
+    parity = sub.add_parser("parity", help="run several ASR engines on the same WAV fixtures and compare them")
+    parity.add_argument("files", nargs="+", help="WAV files; an optional same-named .txt holds the reference transcript")
+    parity.add_argument("--engines", default="whisper,faster-whisper", help="comma-separated engine names")
+    parity.add_argument("--model", help="model size to load in every engine (default: asr.model)")
+    parity.add_argument("--max-wer", type=float, default=0.15, help="largest allowed WER between engines")
+    check = sub.add_parser("commands", help="check every registered command phrase against the parser")
+    check.add_argument("--bench", type=int, default=0, metavar="N", help="also time N parse rounds over all phrases")
+    check.add_argument("--list", action="store_true", help="print every pattern with its example and parsed arguments")
+    procs = sub.add_parser("processes", help="benchmark the process lookup used by 'close <app>'")
+    procs.add_argument("--synthetic", type=int, default=0, metavar="N", help="use a synthetic table of N processes")
+    procs.add_argument("--rounds", type=int, default=1000, help="indexed lookups to time")
+    procs.add_argument("--app", default="firefox", help="process name to look up")
+    bench = sub.add_parser("bench", help="replay WAV fixtures through the full pipeline, headless, and report accuracy and latency")
+    bench.add_argument("fixtures", help="directory with dictation/ and command/ subdirectories of .wav + .txt pairs, optionally idle/ and wake/ .wav files")
+    bench.add_argument("--engines", help="comma-separated engine names (default: asr.engine)")
+    bench.add_argument("--models", help="comma-separated model sizes (default: asr.model)")
+    bench.add_argument("--config", action="append", default=[], metavar="FILE",
+                       help="settings overlay JSON; repeat to compare configs")
+    bench.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                       help="override a setting for every run, e.g. vad.hangover_ms=400")
+    bench.add_argument("--speed", type=float, default=1.0, help="replay speed relative to real time")
+    bench.add_argument("--json", metavar="FILE", help="also write the results as JSON")
+    batch = sub.add_parser("batch", help="transcribe audio files in parallel across all cores")
+    batch.add_argument("files", nargs="+", help="audio files (WAV)")
+    batch.add_argument("--workers", type=int, help="parallel decodes (default: batch.workers)")
+    batch.add_argument("--threads", type=int, help="CPU threads per worker (default: batch.threads_per_worker)")
+    batch.add_argument("--output-dir", help="write one transcript per file here instead of printing")
+    batch.add_argument("--json", action="store_true", help="output segments with timestamps as JSON")
+    batch.add_argument("--scaling", action="store_true", help="benchmark 1, 2, 4, ... workers on the files")
+    enroll = sub.add_parser("enroll", help="record the wake phrase a few times as templates for the wake word detector")
+    enroll.add_argument("--count", type=int, default=3, help="how many times to say it")
+    enroll.add_argument("--files", nargs="+", default=(), metavar="WAV", help="use these recordings instead of the microphone")
+    journal_cmd = sub.add_parser("journal", help="show recent transcripts and commands from the journal")
+    journal_cmd.add_argument("--search", help="only entries whose text contains this")
+    journal_cmd.add_argument("--mode", choices=["dictation", "command"], help="only entries spoken in this mode")
+    journal_cmd.add_argument("--hours", type=float, help="only entries from the last H hours")
+    journal_cmd.add_argument("--limit", type=int, default=20, help="newest N entries (default 20)")
+    journal_cmd.add_argument("--json", action="store_true", help="print the entries as JSON")
+    daemon_cmd = sub.add_parser("daemon", help="run headless: keep the model loaded and serve the control socket")
+    daemon_cmd.add_argument("--self-test", action="store_true",
+                            help="check the control protocol's error handling on a throwaway port, then exit")
+    ctl = sub.add_parser("ctl", help="send one request to the running daemon and print the result")
+    ctl.add_argument("method", help="wake, sleep, toggle, set_mode, get_state, stats, transcribe_file, "
+                                       "transcribe_batch, reload_config, journal, undo, subscribe, shutdown")
+    ctl.add_argument("params", nargs="*", metavar="KEY=VALUE", help="request parameters, e.g. mode=command")
+    args = parser.parse_args(argv)
+
+    if args.command == "parity":
+        return run_parity(args.files, args.engines.split(","), args.model, args.max_wer)
+    if args.command == "commands":
+        return run_command_check(args.bench, args.list)
+    if args.command == "processes":
+        return run_process_bench(args.synthetic, args.rounds, args.app)
+    if args.command == "bench":
+        if args.speed <= 0:
+            parser.error("--speed must be positive")
+        return run_bench(args.fixtures, args.engines.split(",") if args.engines else None,
+                         args.models.split(",") if args.models else None, args.config, args.set,
+                         args.speed, args.json)
+
+    if args.command == "batch":
+        if args.scaling:
+            return run_batch_scaling(args.files, args.workers, args.threads)
+        return run_batch(args.files, args.workers, args.threads, args.output_dir, args.json)
+    if args.command == "enroll":
+        return run_enroll(args.count, args.files)
+    if args.command == "journal":
+        return run_journal(args.search, args.mode, args.hours, args.limit, args.json)
+    if args.command == "daemon":
+        return run_daemon_self_test() if args.self_test else run_daemon()
+    if args.command == "ctl":
+        return run_ctl(args.method, args.params)
+
+    # The widget is a client: the daemon (started here if needed) keeps the
+    # model loaded across UI restarts
+    global control_client
     signal.signal(signal.SIGINT, lambda sig, frame: sys.exit(0))
-    threading.Thread(target=dictation_loop, daemon=True).start()
+    try:
+        control_client = ensure_daemon()
+    except OSError as e:
+        print(f"[ERROR] Could not reach or start the dictation daemon at {control_address()}: {e}")
+        return 1
+    # The widget needs only state and model; the debug window subscribes to
+    # the busier topics itself while it is open
+    DaemonEvents(["state", "model"])
     app = QtWidgets.QApplication(sys.argv)
     widget = DictationWidget()
-    updater = threading.Thread(target=update_widget_periodically, args=(widget,), daemon=True)
-    updater.start()
-    sys.exit(app.exec_())
\ No newline at end of file
+    return app.exec_()
+
+
+if __name__ == "__main__":
+    sys.exit(main())